@@ -0,0 +1,310 @@
+#!/usr/bin/python3
+# Benchmark of since.py, and the bundled templates, against large archives
+#
+# Distributed under the terms of the GNU Public License (GPLv3)
+
+"""
+Measure what $since, and the rest of the bundled mastodon.txt.tmpl and
+mastsummary.txt.tmpl, cost as an archive grows.
+
+Synthetic SQLite weewx archives (wview_extended schema, with daily
+summaries) are built for each combination of --years and --interval and kept
+in --cache-dir, as the 10 year, 1 minute archive takes a while to build.
+
+Each template is then rendered through Cheetah with the usual weewx tags and
+the Since SLE, at report times chosen to land just after midnight, either
+side of the 9am 'since' hour, and on the days daylight saving starts and
+ends in --tz. The whole template, and each $tag in it, is timed and the SQL
+statements it runs are counted.
+
+Usage, from the top of the repository:
+
+    python3 bench/bench_since.py                    # 1, 5, 10 years; 1, 5 min
+    python3 bench/bench_since.py --years 1 --interval 5
+    python3 bench/bench_since.py --json since.json
+
+Needs weewx and Cheetah3, as installed on a weewx host.
+"""
+
+import argparse
+import datetime
+import json
+import math
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'bin'))
+
+from Cheetah.Template import Template
+
+import schemas.wview_extended
+import weewx
+import weewx.manager
+import weewx.tags
+import weewx.units
+from weeutil.weeutil import TimeSpan
+
+import user.since
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                            'skins', 'Seasons', 'DATA')
+TEMPLATES = ('mastodon.txt.tmpl', 'mastsummary.txt.tmpl')
+
+# a $tag, with optional (arguments) on each part
+TAG_RE = re.compile(r'\$[A-Za-z]\w*(?:\([^)]*\))?(?:\.\w+(?:\([^)]*\))?)*')
+
+COLUMNS = ('dateTime', 'usUnits', 'interval', 'outTemp', 'outHumidity',
+           'dewpoint', 'barometer', 'windSpeed', 'windDir', 'windGust',
+           'rain', 'rainRate')
+
+
+class Generator(object):
+    """Just enough of a CheetahGenerator for the Since SLE."""
+
+    def __init__(self, formatter, converter):
+        self.formatter = formatter
+        self.converter = converter
+
+
+class Station(object):
+    location = 'Benchmark Station'
+
+
+def gen_rows(start_ts, stop_ts, interval_min, seed=0):
+    """Yield synthetic US unit archive rows, with daily and yearly cycles."""
+    rnd = random.Random(seed)
+    step = interval_min * 60
+    raining = 0
+    ts = start_ts + step
+    while ts <= stop_ts:
+        day = 2 * math.pi * (ts % 86400) / 86400.0
+        year = 2 * math.pi * (ts % 31557600) / 31557600.0
+        temp = 60 + 15 * math.sin(year) + 10 * math.sin(day) + rnd.gauss(0, 1)
+        hum = max(5.0, min(100.0, 65 - 20 * math.sin(day) + rnd.gauss(0, 3)))
+        wind = abs(6 + 4 * math.sin(day) + rnd.gauss(0, 2))
+        if raining:
+            raining -= 1
+        elif rnd.random() < 0.002:
+            raining = rnd.randint(3, 60)
+        rain = 0.01 * rnd.randint(1, 3) if raining else 0.0
+        yield (ts, weewx.US, interval_min, temp, hum, temp - (100 - hum) / 2.8,
+               29.9 + 0.3 * math.sin(year * 20) + rnd.gauss(0, 0.01),
+               wind, rnd.uniform(0, 360), wind + abs(rnd.gauss(4, 2)),
+               rain, rain * 60.0 / interval_min)
+        ts += step
+
+
+def build_archive(path, years, interval_min, stop_ts):
+    """Create (if not already cached) the archive and its daily summaries."""
+    database_dict = {'database_name': os.path.basename(path),
+                     'SQLITE_ROOT': os.path.dirname(path),
+                     'driver': 'weedb.sqlite'}
+    if os.path.exists(path):
+        return database_dict
+    t0 = time.time()
+    start_ts = stop_ts - int(years * 365.25 * 86400)
+    start_ts -= start_ts % (interval_min * 60)
+    print("building %s ..." % path, end=' ', flush=True)
+    with weewx.manager.DaySummaryManager.open_with_create(
+            database_dict, schema=schemas.wview_extended.schema) as manager:
+        sql = "INSERT INTO archive (%s) VALUES (%s)" % (
+            ', '.join(COLUMNS), ', '.join('?' * len(COLUMNS)))
+        conn = manager.connection.connection
+        rows = gen_rows(start_ts, stop_ts, interval_min)
+        while True:
+            chunk = [row for _, row in zip(range(50000), rows)]
+            if not chunk:
+                break
+            conn.executemany(sql, chunk)
+            conn.commit()
+        manager.backfill_day_summary(progress_fn=None)
+    print("%.1f s" % (time.time() - t0))
+    return database_dict
+
+
+def dst_days(start_ts, stop_ts):
+    """Local dates on which the UTC offset changes, latest first."""
+    days = []
+    d = datetime.date.fromtimestamp(start_ts) + datetime.timedelta(days=1)
+    last = datetime.date.fromtimestamp(stop_ts)
+    while d < last:
+        noon = time.mktime(d.timetuple()) + 43200
+        if time.localtime(noon).tm_isdst != \
+           time.localtime(noon - 86400).tm_isdst:
+            days.append(d)
+        d += datetime.timedelta(days=1)
+    return list(reversed(days))
+
+
+def report_times(manager):
+    """(label, report time) pairs to render at, all on archive records."""
+    first = manager.firstGoodStamp()
+    last = manager.lastGoodStamp()
+    day = datetime.date.fromtimestamp(last) - datetime.timedelta(days=1)
+
+    def at(d, hour, minute):
+        return int(time.mktime(datetime.datetime(
+            d.year, d.month, d.day, hour, minute).timetuple()))
+
+    times = [('00:05 after midnight', at(day, 0, 5)),
+             ('08:55 since crosses midnight', at(day, 8, 55)),
+             ('09:05 since 9am', at(day, 9, 5)),
+             ('23:55 end of day', at(day, 23, 55))]
+    for d in dst_days(first, last)[:2]:
+        label = 'DST %s' % d.isoformat()
+        times.append((label + ' 04:05', at(d, 4, 5)))
+        times.append((label + ' 09:05', at(d, 9, 5)))
+    # snap each onto an archive record, as a report would be
+    snapped = []
+    for label, ts in times:
+        row = manager.getSql("SELECT MAX(dateTime) FROM archive "
+                             "WHERE dateTime <= ?", (ts,))
+        if row and row[0]:
+            snapped.append((label, row[0]))
+    return snapped
+
+
+class QueryCounter(object):
+
+    def __init__(self, manager):
+        self.count = 0
+        manager.connection.connection.set_trace_callback(self.trace)
+
+    def trace(self, statement):
+        self.count += 1
+
+
+def search_list(manager, report_ts):
+    def db_lookup(data_binding=None):
+        return manager
+    formatter = weewx.units.Formatter()
+    converter = weewx.units.StdUnitConverters[weewx.METRIC]
+    time_binder = weewx.tags.TimeBinder(
+        db_lookup, report_ts, formatter=formatter, converter=converter,
+        trend={'time_delta': 10800, 'time_grace': 300})
+    binders = [{'station': Station()}, time_binder]
+    if hasattr(weewx.tags, 'RecordBinder'):
+        # weewx 5 moved $current out of TimeBinder
+        binders.append(weewx.tags.RecordBinder(
+            db_lookup, report_ts, formatter=formatter, converter=converter))
+    since = user.since.Since(Generator(formatter, converter))
+    first = manager.firstGoodStamp()
+    extension = since.get_extension_list(TimeSpan(first, report_ts), db_lookup)
+    return binders + extension
+
+
+def template_tags(path):
+    tags = []
+    with open(path) as f:
+        for line in f:
+            if line.lstrip().startswith('##'):
+                continue
+            for tag in TAG_RE.findall(line):
+                if tag not in tags:
+                    tags.append(tag)
+    return tags
+
+
+def timed(func, counter, repeat):
+    """Best time of 'repeat' runs, and the SQL statements in one run."""
+    best = None
+    for _ in range(repeat):
+        counter.count = 0
+        t0 = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best, counter.count
+
+
+def bench_archive(database_dict, args):
+    results = []
+    with weewx.manager.DaySummaryManager.open(database_dict) as manager:
+        counter = QueryCounter(manager)
+        nrecs = manager.getSql("SELECT COUNT(*) FROM archive")[0]
+        for label, report_ts in report_times(manager):
+            sl = search_list(manager, report_ts)
+            for name in TEMPLATES:
+                path = os.path.join(TEMPLATE_DIR, name)
+                tmpl = Template(file=path, searchList=sl)
+                t, q = timed(lambda: str(tmpl), counter, args.repeat)
+                entry = {'archive': database_dict['database_name'],
+                         'records': nrecs, 'when': label,
+                         'report_time': report_ts, 'template': name,
+                         'seconds': t, 'queries': q, 'tags': {}}
+                for tag in template_tags(path):
+                    try:
+                        tag_tmpl = Template(source=tag, searchList=sl)
+                        tt, tq = timed(lambda: str(tag_tmpl), counter,
+                                       args.repeat)
+                    except Exception as e:
+                        entry['tags'][tag] = {'error': str(e)}
+                        continue
+                    entry['tags'][tag] = {'seconds': tt, 'queries': tq}
+                results.append(entry)
+                print("  %-36s %-22s %8.2f ms %5d queries" % (
+                      label, name, t * 1000, q))
+                if args.tags:
+                    for tag, r in entry['tags'].items():
+                        if 'error' in r:
+                            print("      %-50s %s" % (tag, r['error']))
+                        else:
+                            print("      %-50s %8.2f ms %5d" % (
+                                  tag, r['seconds'] * 1000, r['queries']))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark since.py and the bundled templates")
+    parser.add_argument('--years', default='1,5,10',
+                        help="comma separated archive lengths, years "
+                             "(default 1,5,10)")
+    parser.add_argument('--interval', default='1,5',
+                        help="comma separated archive intervals, minutes "
+                             "(default 1,5)")
+    parser.add_argument('--tz', default='Australia/Melbourne',
+                        help="time zone, one with daylight saving "
+                             "(default Australia/Melbourne)")
+    parser.add_argument('--cache-dir',
+                        default=os.path.join(os.path.expanduser('~'),
+                                             '.cache', 'wxtoot-bench'),
+                        help="where the synthetic archives are kept")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="timing repeats, the best is kept (default 3)")
+    parser.add_argument('--tags', action='store_true',
+                        help="print the time for each tag, not just totals")
+    parser.add_argument('--json', metavar='FILE',
+                        help="write all the results to FILE")
+    args = parser.parse_args()
+
+    os.environ['TZ'] = args.tz
+    time.tzset()
+    if not os.path.isdir(args.cache_dir):
+        os.makedirs(args.cache_dir)
+    # a fixed end, so a cached archive stays valid
+    stop_ts = int(time.mktime((2024, 6, 1, 0, 0, 0, 0, 0, -1)))
+
+    results = []
+    for years in [float(y) for y in args.years.split(',')]:
+        for interval in [int(i) for i in args.interval.split(',')]:
+            name = 'since-%gy-%dm-%s.sdb' % (years, interval,
+                                             args.tz.replace('/', '_'))
+            database_dict = build_archive(
+                os.path.join(args.cache_dir, name), years, interval, stop_ts)
+            print("%s" % name)
+            results.extend(bench_archive(database_dict, args))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'since': user.since.VERSION,
+                       'weewx': weewx.__version__,
+                       'tz': args.tz, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,320 @@
+#!/usr/bin/python3
+# Micro-benchmarks for wxtoot (Mastodon uploader)
+#
+# Distributed under the terms of the GNU Public License (GPLv3)
+
+"""
+Offline micro-benchmarks for the per-record paths of wxtoot.py
+
+Nothing is posted, the Mastodon client is replaced by a stub that counts
+calls. weewx and Mastodon.py must be importable, as they are on a weewx host.
+
+Covered:
+
+  format_toot   the 'full' default (_DEFAULT_FORMAT_2) and a large custom
+                format, against synthetic records 10, 50 and 200 fields wide
+  format_batch  format_batch() over a block of BLOCK records, against
+                to_std_system and format_toot for each of them, after
+                checking that both give the same toots
+  dir_to_ord    _dir_to_ord over a sweep of wind directions
+  images        select_images() with named images and a glob over synthetic
+                image directories of 10 to 10,000 files, scanned each time
+                (glob) and from the unchanged directory cache (glob-cached)
+  template      process_record() reading a template file (1 KB and 16 KB)
+  post          post_with_retries() with 4 images and the stub client
+
+Usage, from the top of the repository:
+
+    python3 bench/bench_wxtoot.py                      # run, print results
+    python3 bench/bench_wxtoot.py --save base.json     # record a baseline
+    python3 bench/bench_wxtoot.py --compare base.json  # flag regressions
+
+With --compare the exit status is 1 if any benchmark is slower than the
+baseline by more than --tolerance (default 0.25, ie 25%).
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'bin'))
+
+import weewx
+import weewx.units
+
+import user.wxtoot as wxtoot
+
+WIDTHS = (10, 50, 200)
+DIR_SIZES = (10, 100, 1000, 10000)
+TEMPLATE_SIZES = (1024, 16 * 1024)
+BLOCK = 1000
+
+
+class StubMastodon(object):
+    """Stands in for mastodon.Mastodon, no network."""
+
+    def __init__(self):
+        self.media = 0
+        self.statuses = 0
+
+    def media_post(self, media_file, mime_type=None, file_name=None, **kw):
+        self.media += 1
+        return {'id': str(self.media)}
+
+    def status_post(self, status, **kw):
+        self.statuses += 1
+        return {'id': str(self.statuses)}
+
+    def instance(self):
+        # no configuration, so the Mastodon default limits
+        return {}
+
+
+def make_thread(**kw):
+    """A TootThread with the stub client. It is never started."""
+    args = dict(images='', dev_mode=False, server_url_image='',
+                image_directory='', template_file='', template_last_file='',
+                key_access_token='bench', server_url_mastodon='http://127.0.0.1',
+                visibility='direct', cardinal=True, format_choice='full',
+                station='Bench', format=wxtoot.Toot._DEFAULT_FORMAT_2,
+                format_None=wxtoot.Toot._DEFAULT_FORMAT_NONE,
+                ordinals=wxtoot.Toot._DEFAULT_ORDINALS, post_interval=None,
+                unit_system=weewx.METRIC)
+    args.update(kw)
+    thread = wxtoot.TootThread(wxtoot.TootQueue(), **args)
+    thread.mstdn = StubMastodon()
+    return thread
+
+
+def known_obs():
+    """Observation types that have a unit in the METRIC system."""
+    return sorted(k for k in weewx.units.obs_group_dict
+                  if weewx.units.getStandardUnitType(weewx.METRIC, k)[0]
+                  not in (None, 'uv_index', 'degree_compass', 'unix_epoch'))
+
+
+def make_record(width):
+    """A US unit record, 'width' fields wide, as it arrives from the queue.
+
+    The fields the default format uses come first, then real observation
+    types, then made up ones (as a wide LOOP packet would carry).
+    """
+    record = {'dateTime': 1672531200, 'usUnits': weewx.US,
+              'windSpeed': 12.3, 'windDir': 247.0, 'windGust': 18.9,
+              'outTemp': 71.3, 'outHumidity': 54.0, 'barometer': 30.012,
+              'rain': 0.01, 'binding': 'archive'}
+    extra = [k for k in known_obs() if k not in record]
+    i = 0
+    while len(record) < width:
+        if i < len(extra):
+            record[extra[i]] = 10.0 + i
+        else:
+            record['field%03d' % i] = float(i)
+        i += 1
+    return record
+
+
+def large_format():
+    """A custom format with a placeholder for every known observation."""
+    return '{station:%s}\n' + '\n'.join(
+        ' %s: {%s:%%.2f}' % (k, k) for k in known_obs())
+
+
+def make_image_dir(root, count):
+    path = os.path.join(root, 'img%d' % count)
+    os.mkdir(path)
+    exts = ('.png', '.jpg', '.gif', '.webp', '.txt')
+    for i in range(count):
+        with open(os.path.join(path, 'image%05d%s' % (i, exts[i % 5])),
+                  'wb') as f:
+            f.write(b'\x89PNG')
+    return path
+
+
+def make_template(root, size):
+    path = os.path.join(root, 'template%d.txt' % size)
+    line = 'Temp: (min: 12.3C)    17.8C    (max: 21.0C)\\n\n'
+    with open(path, 'w') as f:
+        f.write((line * (size // len(line) + 1))[:size])
+    return path
+
+
+def measure(func, repeat):
+    """Best time per call, in microseconds."""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    best = min(timer.repeat(repeat=repeat, number=number))
+    return best / number * 1e6
+
+
+def per_record(thread, records):
+    """Render records one at a time, as _process_record does."""
+    return [thread.format_toot(dict(
+                weewx.units.to_std_system(dict(r), thread.unit_system),
+                station=thread.station)) for r in records]
+
+
+def check_batch(thread, columns, records):
+    """format_batch must give the very strings per_record does."""
+    batch = thread.format_batch(columns)
+    for i, toot in enumerate(per_record(thread, records)):
+        if batch[i] != toot:
+            raise SystemExit("format_batch differs from format_toot at "
+                             "record %d:\n%r\n%r" % (i, batch[i], toot))
+
+
+def benchmarks(root):
+    """Yield (name, callable) pairs."""
+    full = make_thread()
+    big = make_thread(format=large_format())
+    for width in WIDTHS:
+        record = make_record(width)
+        record['station'] = 'Bench'
+        yield ('format_toot/full/w%d' % width,
+               lambda r=record: full.format_toot(dict(r)))
+        yield ('format_toot/large/w%d' % width,
+               lambda r=record: big.format_toot(dict(r)))
+        yield ('to_std_system+format_toot/full/w%d' % width,
+               lambda r=record: full.format_toot(
+                   weewx.units.to_std_system(dict(r), weewx.METRIC)))
+
+    for width in WIDTHS:
+        base = make_record(width)
+        records = [dict(base, dateTime=base['dateTime'] + 300 * i,
+                        outTemp=50.0 + i % 40, windDir=(i * 7.3) % 360)
+                   for i in range(BLOCK)]
+        for i in range(0, BLOCK, 7):
+            records[i]['windGust'] = None
+        columns = dict((k, [r[k] for r in records]) for k in base)
+        for thread in (full, big):
+            check_batch(thread, columns, records)
+        yield ('format_batch/full/w%d/n%d' % (width, BLOCK),
+               lambda c=columns: full.format_batch(c))
+        yield ('per_record/full/w%d/n%d' % (width, BLOCK),
+               lambda rs=records: per_record(full, rs))
+
+    directions = [d * 0.7 for d in range(515)] + [None, -10.0, 400.0]
+
+    def sweep():
+        for d in directions:
+            if d is not None:
+                wxtoot._dir_to_ord(d, wxtoot.Toot._DEFAULT_ORDINALS)
+    yield ('dir_to_ord/sweep%d' % len(directions), sweep)
+
+    def cold(thread):
+        # a new cache each call, so the directory really is scanned
+        thread.image_cache = wxtoot.ImageCache()
+        return thread.select_images('')
+
+    dirs = {}
+    for count in DIR_SIZES:
+        dirs[count] = make_image_dir(root, count)
+        thread = make_thread(image_directory=dirs[count])
+        yield ('images/glob/n%d' % count, lambda t=thread: cold(t))
+        yield ('images/glob-cached/n%d' % count,
+               lambda t=thread: t.select_images(''))
+    named_dir = make_image_dir(root, 4)
+    named = make_thread(image_directory=named_dir,
+                        images=sorted(os.listdir(named_dir)))
+    yield ('images/named/4', lambda: named.select_images(''))
+
+    for size in TEMPLATE_SIZES:
+        thread = make_thread(format_choice='template',
+                             template_file=make_template(root, size))
+        # an hour that is never the summary hour
+        thread.summary_time = 99
+        # an instance that takes the whole template in one status, so this
+        # times the template read, as it did before toots were split
+        thread.limits = dict(wxtoot.instance_limits({}),
+                             max_characters=2 * size)
+        thread.limits_ts = time.time()
+        record = make_record(10)
+        yield ('template/process_record/%dB' % size,
+               lambda t=thread, r=record: t.process_record(dict(r), None))
+
+    post = make_thread(image_directory=make_image_dir(root, 8))
+    yield ('post/stub/4images',
+           lambda: post.post_with_retries('bench'))
+    # the scan is cached, so this times the media checks before posting
+    big = max(DIR_SIZES)
+    post_big = make_thread(image_directory=dirs[big])
+    yield ('post/stub/dir%d' % big,
+           lambda: post_big.post_with_retries('bench'))
+
+
+def run(args):
+    root = tempfile.mkdtemp(prefix='wxtoot-bench-')
+    results = {}
+    try:
+        for name, func in benchmarks(root):
+            if args.filter and args.filter not in name:
+                continue
+            results[name] = measure(func, args.repeat)
+            print("%-42s %12.2f us" % (name, results[name]))
+    finally:
+        shutil.rmtree(root)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Print the change against the baseline, return the regressions."""
+    regressions = []
+    print("\n%-42s %12s %12s %8s" % ('benchmark', 'baseline', 'now', 'ratio'))
+    for name in sorted(results):
+        if name not in baseline:
+            print("%-42s %12s %12.2f" % (name, '-', results[name]))
+            continue
+        ratio = results[name] / baseline[name]
+        flag = ''
+        if ratio > 1.0 + tolerance:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print("%-42s %12.2f %12.2f %7.2fx%s" % (
+              name, baseline[name], results[name], ratio, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Offline micro-benchmarks for wxtoot")
+    parser.add_argument('--save', metavar='FILE',
+                        help="write the results to FILE as a JSON baseline")
+    parser.add_argument('--compare', metavar='FILE',
+                        help="compare against the JSON baseline in FILE")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="allowed slow down before a regression is "
+                             "flagged (default 0.25)")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="timing repeats, the best is kept (default 5)")
+    parser.add_argument('--filter', metavar='TEXT',
+                        help="only run benchmarks whose name contains TEXT")
+    args = parser.parse_args()
+
+    results = run(args)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'wxtoot': wxtoot.VERSION,
+                       'weewx': weewx.__version__,
+                       'python': platform.python_version(),
+                       'machine': platform.machine(),
+                       'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+                       'results_us': results}, f, indent=2, sort_keys=True)
+        print("baseline saved to %s" % args.save)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results_us']
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,333 @@
+#!/usr/bin/python3
+# A local stand-in for a Mastodon instance and an image server
+#
+# Distributed under the terms of the GNU Public License (GPLv3)
+
+"""
+A local HTTP stand-in for the parts of the Mastodon API that wxtoot uses,
+plus an image server, with fault injection. For load and fault testing only.
+
+Endpoints:
+
+    GET  /api/v1/instance, /api/v2/instance    instance info and limits
+    GET  /api/v1/accounts/verify_credentials   the bot account
+    POST /api/v1/media, /api/v2/media          media upload
+    POST /api/v1/statuses                      status post, a repeated
+                                               Idempotency-Key gets the
+                                               status it first made
+    GET  /image.png                            the image server
+
+Faults, all off by default:
+
+    latency        seconds added to every API response (plus latency_jitter)
+    error_rate     fraction of API requests answered with a 503
+    limit_every    every Nth API request is answered with a 429, with
+                   X-RateLimit-* headers asking the client to wait limit_wait
+                   seconds
+    upload_bps     upload bodies are read at no more than this many bytes
+                   per second
+
+It can be run on its own, eg to point a test weewx at:
+
+    python3 bench/fakemastodon.py --port 8899 --latency 0.2 --error-rate 0.1
+"""
+
+import argparse
+import collections
+import datetime
+import json
+import random
+import threading
+import time
+
+try:
+    from urllib.parse import parse_qs
+except ImportError:
+    from urlparse import parse_qs
+
+try:
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+except ImportError:
+    # python < 3.7
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+    class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+# the smallest valid PNG (1x1, white)
+PNG_1X1 = bytes.fromhex(
+    '89504e470d0a1a0a0000000d4948445200000001000000010802000000907753'
+    'de0000000c4944415408d763f8ffff3f0005fe02fea7d69c1f0000000049454e'
+    '44ae426082')
+
+
+def _iso(ts):
+    return datetime.datetime.utcfromtimestamp(ts).strftime(
+        '%Y-%m-%dT%H:%M:%S.000Z')
+
+
+class FakeMastodon(object):
+    """The server state, faults and statistics. Thread safe."""
+
+    def __init__(self, latency=0.0, latency_jitter=0.0, error_rate=0.0,
+                 limit_every=0, limit_wait=1.0, upload_bps=0,
+                 max_characters=500, max_media=4, image_bytes=None,
+                 seed=None):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.limit_every = limit_every
+        self.limit_wait = limit_wait
+        self.upload_bps = upload_bps
+        self.max_characters = max_characters
+        self.max_media = max_media
+        self.image_bytes = image_bytes or PNG_1X1
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.api_requests = 0
+        self.next_id = 100000
+        # (endpoint, status) -> count
+        self.counts = collections.Counter()
+        self.bytes_in = 0
+        # (arrival time, text) of every accepted status
+        self.statuses = []
+        # Idempotency-Key -> the status it made
+        self.idempotent = {}
+        self.repeats = 0
+
+    def new_id(self):
+        with self.lock:
+            self.next_id += 1
+            return str(self.next_id)
+
+    def fault(self):
+        """Decide the fault for an API request: None, 429 or 503."""
+        with self.lock:
+            self.api_requests += 1
+            n = self.api_requests
+            roll = self.random.random()
+            jitter = self.random.random() * self.latency_jitter
+        if self.latency or jitter:
+            time.sleep(self.latency + jitter)
+        if self.limit_every and n % self.limit_every == 0:
+            return 429
+        if roll < self.error_rate:
+            return 503
+        return None
+
+    def count(self, endpoint, status, nbytes=0):
+        with self.lock:
+            self.counts[(endpoint, status)] += 1
+            self.bytes_in += nbytes
+
+    def instance(self):
+        return {
+            'uri': 'fake.local', 'title': 'fake', 'version': '4.2.0',
+            'description': '', 'email': '', 'urls': {}, 'stats': {},
+            'languages': ['en'], 'contact_account': None, 'rules': [],
+            'configuration': {
+                'statuses': {'max_characters': self.max_characters,
+                             'max_media_attachments': self.max_media,
+                             'characters_reserved_per_url': 23},
+                'media_attachments': {
+                    'supported_mime_types': ['image/png', 'image/jpeg',
+                                             'image/gif', 'image/webp'],
+                    'image_size_limit': 16777216,
+                    'image_matrix_limit': 33177600}},
+        }
+
+    def account(self):
+        return {'id': '1', 'username': 'wxbot', 'acct': 'wxbot',
+                'display_name': 'wxbot', 'created_at': _iso(0),
+                'note': '', 'url': '', 'followers_count': 0,
+                'following_count': 0, 'statuses_count': len(self.statuses)}
+
+    def media(self):
+        return {'id': self.new_id(), 'type': 'image', 'url': 'http://x/y.png',
+                'preview_url': 'http://x/y.png', 'description': None,
+                'blurhash': None, 'meta': {}}
+
+    def status(self, text, key=None):
+        with self.lock:
+            if key is not None and key in self.idempotent:
+                self.repeats += 1
+                return self.idempotent[key]
+            self.statuses.append((time.time(), text))
+        status = {'id': self.new_id(), 'created_at': _iso(time.time()),
+                  'content': text, 'visibility': 'unlisted',
+                  'media_attachments': [], 'mentions': [], 'tags': [],
+                  'emojis': [], 'account': self.account(), 'reblog': None}
+        if key is not None:
+            with self.lock:
+                self.idempotent[key] = status
+        return status
+
+    def summary(self):
+        with self.lock:
+            counts = dict(('%s %s' % k, v) for k, v in self.counts.items())
+            return {'api_requests': self.api_requests,
+                    'statuses': len(self.statuses),
+                    'idempotent_repeats': self.repeats,
+                    'bytes_in': self.bytes_in,
+                    'responses': counts}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, fmt, *args):
+        pass
+
+    @property
+    def fake(self):
+        return self.server.fake
+
+    def reply(self, endpoint, status, body, headers=None, nbytes=0):
+        self.fake.count(endpoint, status, nbytes)
+        if isinstance(body, bytes):
+            data = body
+            ctype = 'image/png'
+        else:
+            data = json.dumps(body).encode('utf-8')
+            ctype = 'application/json; charset=utf-8'
+        self.send_response(status)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self, upload):
+        """Read the request body, throttled for uploads (which are not
+        kept). Return (body, length)."""
+        length = int(self.headers.get('Content-Length') or 0)
+        left = length
+        chunks = []
+        while left > 0:
+            got = self.rfile.read(min(16384, left))
+            if not got:
+                break
+            left -= len(got)
+            if not upload:
+                chunks.append(got)
+            elif self.fake.upload_bps:
+                time.sleep(len(got) / float(self.fake.upload_bps))
+        return b''.join(chunks), length
+
+    def status_text(self, body):
+        ctype = self.headers.get('Content-Type') or ''
+        try:
+            if ctype.startswith('application/json'):
+                return json.loads(body.decode('utf-8')).get('status', '')
+            return parse_qs(body.decode('utf-8')).get('status', [''])[0]
+        except ValueError:
+            return ''
+
+    def fault_reply(self, endpoint, nbytes=0):
+        """Send the injected fault, if any. Return True if one was sent."""
+        fault = self.fake.fault()
+        if fault == 429:
+            reset = time.time() + self.fake.limit_wait
+            self.reply(endpoint, 429, {'error': 'Too many requests'}, {
+                'X-RateLimit-Limit': '300',
+                'X-RateLimit-Remaining': '0',
+                'X-RateLimit-Reset': _iso(reset)}, nbytes)
+            return True
+        if fault == 503:
+            self.reply(endpoint, 503, {'error': 'Service unavailable'},
+                       nbytes=nbytes)
+            return True
+        return False
+
+    def do_GET(self):
+        path = self.path.split('?')[0].rstrip('/')
+        if path == '/image.png':
+            self.reply('image', 200, self.fake.image_bytes)
+            return
+        if self.fault_reply(path):
+            return
+        if path in ('/api/v1/instance', '/api/v2/instance'):
+            self.reply(path, 200, self.fake.instance())
+        elif path == '/api/v1/accounts/verify_credentials':
+            self.reply(path, 200, self.fake.account())
+        else:
+            self.reply(path, 404, {'error': 'Record not found'})
+
+    def do_POST(self):
+        path = self.path.split('?')[0].rstrip('/')
+        upload = path in ('/api/v1/media', '/api/v2/media')
+        body, nbytes = self.read_body(upload)
+        if self.fault_reply(path, nbytes):
+            return
+        if upload:
+            self.reply(path, 200, self.fake.media(), nbytes=nbytes)
+        elif path == '/api/v1/statuses':
+            self.reply(path, 200, self.fake.status(
+                self.status_text(body), self.headers.get('Idempotency-Key')),
+                nbytes=nbytes)
+        else:
+            self.reply(path, 404, {'error': 'Record not found'},
+                       nbytes=nbytes)
+
+
+def start_server(fake, host='127.0.0.1', port=0):
+    """Serve 'fake' on a daemon thread. Return (server, base_url)."""
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.fake = fake
+    thread = threading.Thread(target=server.serve_forever, name='fakemastodon')
+    thread.daemon = True
+    thread.start()
+    return server, 'http://%s:%d' % server.server_address[:2]
+
+
+def add_fault_options(parser):
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="seconds added to each API response")
+    parser.add_argument('--latency-jitter', type=float, default=0.0,
+                        help="up to this many extra seconds, at random")
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help="fraction of API requests answered with 503")
+    parser.add_argument('--limit-every', type=int, default=0,
+                        help="answer every Nth API request with a 429")
+    parser.add_argument('--limit-wait', type=float, default=1.0,
+                        help="seconds a 429 asks the client to wait")
+    parser.add_argument('--upload-bps', type=int, default=0,
+                        help="throttle uploads to this many bytes/second")
+    parser.add_argument('--seed', type=int, default=None,
+                        help="random seed, for repeatable faults")
+
+
+def fake_from_args(args):
+    return FakeMastodon(latency=args.latency,
+                        latency_jitter=args.latency_jitter,
+                        error_rate=args.error_rate,
+                        limit_every=args.limit_every,
+                        limit_wait=args.limit_wait,
+                        upload_bps=args.upload_bps,
+                        seed=args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="A local fake Mastodon instance and image server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8899)
+    add_fault_options(parser)
+    args = parser.parse_args()
+
+    fake = fake_from_args(args)
+    server, url = start_server(fake, args.host, args.port)
+    print("serving on %s (image server %s/image.png), ^C to stop" % (url, url))
+    try:
+        while True:
+            time.sleep(10)
+            print(json.dumps(fake.summary()))
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+#!/usr/bin/python3
+# End-to-end load and fault-injection harness for wxtoot (Mastodon uploader)
+#
+# Distributed under the terms of the GNU Public License (GPLv3)
+
+"""
+Drive a real TootThread, with the real Mastodon.py client, against the local
+fake Mastodon instance and image server in fakemastodon.py. Nothing leaves
+the machine.
+
+Simulated LOOP packets and archive records are fed to the thread's queue at
+the given rates, the way Toot.handle_new_loop / handle_new_archive would. The
+fake server can add latency, 429s with rate limit headers, 5xx errors and
+slow uploads (see fakemastodon.py).
+
+Reported: records queued, posted, dropped (by post_interval) and failed,
+throughput, post latency percentiles (queued to posted), queue depth over
+time and memory use.
+
+Example, an archive record every second and 2 LOOP packets a second, for a
+minute, with 10% of requests failing and a 429 every 50 requests:
+
+    python3 bench/load_wxtoot.py --archive-rate 1 --loop-rate 2 \\
+        --binding loop,archive --duration 60 --error-rate 0.1 \\
+        --limit-every 50 --json load.json
+"""
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'bin'))
+
+import weewx
+import weewx.restx
+
+import user.wxtoot as wxtoot
+import fakemastodon
+from bench_wxtoot import make_record
+
+
+class TimedTootThread(wxtoot.TootThread):
+    """A TootThread that records the outcome and latency of each record."""
+
+    def __init__(self, *args, **kwargs):
+        super(TimedTootThread, self).__init__(*args, **kwargs)
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.posted = 0
+        self.failed = 0
+        self.busy = 0.0
+
+    def process_record(self, record, dbmanager):
+        queued = record.pop('queued')
+        start = time.time()
+        try:
+            super(TimedTootThread, self).process_record(record, dbmanager)
+        except weewx.restx.FailedPost:
+            with self.lock:
+                self.failed += 1
+            raise
+        finally:
+            with self.lock:
+                self.busy += time.time() - start
+        with self.lock:
+            self.posted += 1
+            self.latencies.append(time.time() - queued)
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    k = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[k]
+
+
+def make_images(root, count, size):
+    path = os.path.join(root, 'images')
+    os.mkdir(path)
+    for i in range(count):
+        with open(os.path.join(path, 'image%d.png' % i), 'wb') as f:
+            f.write(fakemastodon.PNG_1X1 + b'\0' * max(0, size - 69))
+    return path
+
+
+def drive(thread, args):
+    """Feed records for args.duration seconds. Return the number queued
+    and the queue depth samples."""
+    q = thread.queue
+    base = make_record(args.width)
+    samples = []
+    queued = 0
+    start = time.time()
+    next_loop = next_archive = next_sample = start
+    loop_step = 1.0 / args.loop_rate if args.loop_rate else None
+    archive_step = 1.0 / args.archive_rate if args.archive_rate else None
+    while True:
+        now = time.time()
+        if now - start >= args.duration:
+            break
+        if loop_step and now >= next_loop:
+            if 'loop' in args.binding:
+                record = dict(base, dateTime=now, binding='loop', queued=now)
+                q.put(record)
+                queued += 1
+            next_loop += loop_step
+        if archive_step and now >= next_archive:
+            if 'archive' in args.binding:
+                record = dict(base, dateTime=now, binding='archive',
+                              queued=now)
+                q.put(record)
+                queued += 1
+            next_archive += archive_step
+        if now >= next_sample:
+            samples.append((round(now - start, 2), q.qsize()))
+            next_sample += args.sample
+        wake = min(x for x in (next_loop if loop_step else None,
+                               next_archive if archive_step else None,
+                               next_sample) if x is not None)
+        time.sleep(max(0.0, wake - time.time()))
+    return queued, samples
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Load and fault-injection harness for wxtoot")
+    parser.add_argument('--duration', type=float, default=30.0,
+                        help="seconds to feed records for (default 30)")
+    parser.add_argument('--loop-rate', type=float, default=0.0,
+                        help="LOOP packets per second (default 0)")
+    parser.add_argument('--archive-rate', type=float, default=1.0,
+                        help="archive records per second (default 1)")
+    parser.add_argument('--binding', default='archive',
+                        help="loop, archive or both, as in weewx.conf")
+    parser.add_argument('--post-interval', type=float, default=None,
+                        help="the thread's post_interval (default none, "
+                             "post every record)")
+    parser.add_argument('--width', type=int, default=30,
+                        help="fields per record (default 30)")
+    parser.add_argument('--images', type=int, default=2,
+                        help="image files to upload with each post")
+    parser.add_argument('--image-size', type=int, default=50000,
+                        help="bytes per image file (default 50000)")
+    parser.add_argument('--image-server', action='store_true',
+                        help="also fetch an image from the fake image server")
+    parser.add_argument('--max-tries', type=int, default=3)
+    parser.add_argument('--sample', type=float, default=1.0,
+                        help="queue depth sample interval, seconds")
+    parser.add_argument('--drain', type=float, default=60.0,
+                        help="seconds to wait for the queue to empty")
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help="trace python allocations (slower)")
+    parser.add_argument('--json', metavar='FILE',
+                        help="also write the report to FILE")
+    fakemastodon.add_fault_options(parser)
+    args = parser.parse_args()
+
+    if args.tracemalloc:
+        tracemalloc.start()
+
+    fake = fakemastodon.fake_from_args(args)
+    server, url = fakemastodon.start_server(fake)
+    root = tempfile.mkdtemp(prefix='wxtoot-load-')
+    image_dir = make_images(root, args.images, args.image_size) \
+        if args.images else ''
+    thread = TimedTootThread(
+        wxtoot.TootQueue(), images='', dev_mode=False,
+        server_url_image=url + '/image.png' if args.image_server else '',
+        image_directory=image_dir, template_file='', template_last_file='',
+        key_access_token='load', server_url_mastodon=url,
+        visibility='direct', cardinal=True, format_choice='full',
+        station='Load', format=wxtoot.Toot._DEFAULT_FORMAT_2,
+        format_None=wxtoot.Toot._DEFAULT_FORMAT_NONE,
+        ordinals=wxtoot.Toot._DEFAULT_ORDINALS,
+        post_interval=args.post_interval, unit_system=weewx.METRIC,
+        max_tries=args.max_tries, log_success=False, log_failure=False)
+    thread.start()
+
+    start = time.time()
+    try:
+        queued, samples = drive(thread, args)
+        fed = time.time()
+        # let the thread catch up, then stop it
+        while thread.queue.qsize() and time.time() - fed < args.drain:
+            samples.append((round(time.time() - start, 2),
+                            thread.queue.qsize()))
+            time.sleep(args.sample)
+        thread.queue.put(None)
+        thread.join(args.drain)
+        elapsed = time.time() - start
+    finally:
+        server.shutdown()
+        shutil.rmtree(root)
+
+    lat = thread.latencies
+    depths = [d for _, d in samples] or [0]
+    report = {
+        'duration': round(elapsed, 3),
+        'queued': queued,
+        'posted': thread.posted,
+        'failed': thread.failed,
+        'dropped': queued - thread.posted - thread.failed
+        - thread.queue.qsize(),
+        'left_in_queue': thread.queue.qsize(),
+        'throughput_per_s': round(thread.posted / elapsed, 3),
+        'thread_busy_s': round(thread.busy, 3),
+        'latency_s': dict((k, None if v is None else round(v, 4)) for k, v in (
+            ('p50', percentile(lat, 50)), ('p90', percentile(lat, 90)),
+            ('p99', percentile(lat, 99)), ('max', max(lat) if lat else None))),
+        'queue_depth': {'max': max(depths),
+                        'mean': round(sum(depths) / float(len(depths)), 2),
+                        'samples': samples},
+        'memory': {'maxrss_kb': resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss},
+        'server': fake.summary(),
+    }
+    if args.tracemalloc:
+        current, peak = tracemalloc.get_traced_memory()
+        report['memory']['traced_current'] = current
+        report['memory']['traced_peak'] = peak
+
+    printable = dict(report)
+    printable['queue_depth'] = dict(report['queue_depth'])
+    printable['queue_depth'].pop('samples')
+    print(json.dumps(printable, indent=2, sort_keys=True))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
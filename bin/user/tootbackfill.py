@@ -0,0 +1,416 @@
+#!/usr/bin/python3
+# Backfill daily summary toots from the weewx archive
+#
+# Distributed under the terms of the GNU Public License (GPLv3)
+
+"""
+Post daily summaries for past days, eg after an outage or when a new station
+is brought on line. Everything else in wxtoot is driven by NEW_ARCHIVE_RECORD,
+this works straight from the archive.
+
+The [StdRESTful] [[Mastodon]] section of weewx.conf is read as the service
+would read it, and the toots are rendered and posted by a TootThread (which
+is never started), so station, unit_system, visibility, format_None,
+ordinals, skip_upload, max_tries, retry_wait, metrics and traces all apply.
+
+For each day from --from to --to a window is built the way since.py does it:
+from --hour o'clock the day before, to --hour o'clock on the day (the default
+is 9, to match the $since($hour=9) rain of the bundled templates). The
+archive records for the whole date range are streamed through a generator,
+one pass, and reduced to a summary record per window. That record carries
+obstype_min, _max, _avg, _sum, _mintime and _maxtime for each observation
+type the format names, and a dateTime of the end of the window, eg:
+
+    {station:%s} summary to {dateTime:%d %b %Y %H:%M}
+     Max temp: {outTemp_max:%.1f} at {outTemp_maxtime:%H:%M}
+     Rain: {rain_sum:%.1f}
+
+Days with no archive records are skipped. The summaries are rendered in
+blocks, by TootThread.format_batch.
+
+Posts go through a bounded pool of --concurrency workers (default 1, which
+keeps them in date order on the timeline). Each post waits for its slot, at
+no more than --rate posts a minute, and waits out the rest of the rate limit
+period if the server says fewer than --reserve requests are left.
+
+With --dry-run DIR nothing is posted, each rendered toot is written to
+DIR/toot-YYYYmmdd-HHMM.txt instead.
+
+Usage, as the weewx user, with bin (weewx 4) or the weewx-data/bin (weewx 5)
+directory on the PYTHONPATH:
+
+    python3 -m user.tootbackfill /etc/weewx/weewx.conf \\
+        --from 2024-03-01 --to 2024-03-07 --dry-run /tmp/toots
+    python3 -m user.tootbackfill /etc/weewx/weewx.conf \\
+        --from 2024-03-01 --to 2024-03-07 --rate 6
+
+The counts and throughput are printed at the end.
+"""
+
+import argparse
+import concurrent.futures
+import datetime
+import logging
+import os
+import re
+import sys
+import threading
+import time
+
+import weecfg
+import weeutil.logger
+import weewx
+import weewx.manager
+import weewx.restx
+import weewx.units
+
+import user.wxtoot as wxtoot
+
+log = logging.getLogger(__name__)
+
+
+def loginf(msg):
+    log.info(msg)
+
+
+def logerr(msg):
+    log.error(msg)
+
+
+DEFAULT_FORMAT = '{station:%s} summary to {dateTime:%d %b %Y %H:%M}' \
+                 '\n Temp: {outTemp_min:%.1f} at {outTemp_mintime:%H:%M}' \
+                 ' to {outTemp_max:%.1f} at {outTemp_maxtime:%H:%M}' \
+                 '\n Humidity: {outHumidity_min:%.0f}' \
+                 ' to {outHumidity_max:%.0f}' \
+                 '\n Pressure: {barometer_min:%.1f}' \
+                 ' to {barometer_max:%.1f}' \
+                 '\n Wind: avg {windSpeed_avg:%.1f}' \
+                 ' gust {windGust_max:%.1f} at {windGust_maxtime:%H:%M}' \
+                 '\n Rain: {rain_sum:%.1f}'
+
+# summaries rendered together by TootThread.format_batch, about 2 months
+RENDER_BLOCK = 64
+
+# a {obstype_aggregate} or {obstype_aggregate:fmt} placeholder
+AGGREGATE_RE = re.compile(
+    r'{(\w+?)_(min|max|avg|sum|mintime|maxtime)(?::[^}]*)?}')
+
+
+def summary_types(fmt):
+    """The observation types that the placeholders in fmt aggregate."""
+    types = []
+    for obs, _ in AGGREGATE_RE.findall(fmt):
+        if obs not in types:
+            types.append(obs)
+    return types
+
+
+def day_windows(first_day, last_day, hour):
+    """Yield (start_ts, stop_ts) for each day, as since.py would give at
+    'hour' o'clock on the day: from 'hour' o'clock the day before."""
+    day = first_day
+    while day <= last_day:
+        stop_dt = datetime.datetime(day.year, day.month, day.day, hour)
+        start_dt = stop_dt - datetime.timedelta(days=1)
+        yield (int(time.mktime(start_dt.timetuple())),
+               int(time.mktime(stop_dt.timetuple())))
+        day += datetime.timedelta(days=1)
+
+
+def gen_records(dbmanager, start_ts, stop_ts):
+    """Yield the archive records after start_ts, up to and including
+    stop_ts, oldest first."""
+    for record in dbmanager.genBatchRecords(start_ts, stop_ts):
+        yield record
+
+
+class Summary(object):
+    """The aggregates of some observation types over one window."""
+
+    def __init__(self, start_ts, stop_ts, obs_types):
+        self.start_ts = start_ts
+        self.stop_ts = stop_ts
+        self.obs_types = obs_types
+        self.count = 0
+        self.min = {}
+        self.mintime = {}
+        self.max = {}
+        self.maxtime = {}
+        self.sum = {}
+        self.wsum = {}
+        self.sumtime = {}
+
+    def add(self, record):
+        ts = record['dateTime']
+        # weight averages by the archive interval, as the daily summaries do
+        weight = (record.get('interval') or 1) * 60
+        self.count += 1
+        for obs in self.obs_types:
+            value = record.get(obs)
+            if value is None:
+                continue
+            if obs not in self.min or value < self.min[obs]:
+                self.min[obs] = value
+                self.mintime[obs] = ts
+            if obs not in self.max or value > self.max[obs]:
+                self.max[obs] = value
+                self.maxtime[obs] = ts
+            self.sum[obs] = self.sum.get(obs, 0.0) + value
+            self.wsum[obs] = self.wsum.get(obs, 0.0) + value * weight
+            self.sumtime[obs] = self.sumtime.get(obs, 0) + weight
+
+    def record(self, unit_system):
+        """The summary as a record for TootThread.format_toot."""
+        record = {'dateTime': self.stop_ts, 'usUnits': unit_system,
+                  'count': self.count}
+        for obs in self.obs_types:
+            found = obs in self.min
+            record[obs + '_min'] = self.min.get(obs)
+            record[obs + '_mintime'] = self.mintime.get(obs)
+            record[obs + '_max'] = self.max.get(obs)
+            record[obs + '_maxtime'] = self.maxtime.get(obs)
+            record[obs + '_sum'] = self.sum.get(obs)
+            record[obs + '_avg'] = \
+                self.wsum[obs] / self.sumtime[obs] if found else None
+        return record
+
+
+def gen_summaries(records, windows, obs_types, unit_system=None):
+    """Reduce the stream of archive records to a Summary for each window.
+
+    Both must be in time order. Records are converted to unit_system, if it
+    is given, before they are aggregated. Windows without records are
+    skipped.
+    """
+    # only what is aggregated is converted, archive records are wide
+    keep = ['dateTime', 'usUnits', 'interval'] + list(obs_types)
+    windows = iter(windows)
+    window = next(windows, None)
+    summary = None
+    for record in records:
+        ts = record['dateTime']
+        while window is not None and ts > window[1]:
+            if summary is not None:
+                yield summary
+                summary = None
+            window = next(windows, None)
+        if window is None:
+            break
+        if ts <= window[0]:
+            # before this window, between days when the hour wraps
+            continue
+        if summary is None:
+            summary = Summary(window[0], window[1], obs_types)
+        if unit_system is not None and record['usUnits'] != unit_system:
+            record = weewx.units.to_std_system(
+                dict((k, record[k]) for k in keep if k in record),
+                unit_system)
+        summary.add(record)
+    if summary is not None:
+        yield summary
+
+
+class Pacer(object):
+    """Space posts out to no more than 'rate' a minute and keep clear of the
+    server's rate limit, as last reported to the Mastodon client."""
+
+    def __init__(self, mstdn, rate=0, reserve=10):
+        self.mstdn = mstdn
+        self.gap = 60.0 / rate if rate else 0.0
+        self.reserve = reserve
+        self.lock = threading.Lock()
+        self.next_ts = 0.0
+        self.waited = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            delay = max(0.0, self.next_ts - now)
+            remaining = getattr(self.mstdn, 'ratelimit_remaining', None)
+            reset = getattr(self.mstdn, 'ratelimit_reset', None)
+            if remaining is not None and reset and \
+               remaining <= self.reserve:
+                delay = max(delay, reset - now)
+                loginf("%s requests left, waiting %.0f seconds for the "
+                       "rate limit to reset" % (remaining, delay))
+            # claim the slot, then sleep outside the lock
+            self.next_ts = now + delay + self.gap
+            self.waited += delay
+        if delay > 0:
+            time.sleep(delay)
+
+
+class Backfill(object):
+    """Render summaries with a TootThread, then post them with a bounded
+    pool of workers, or write them to dry_run."""
+
+    def __init__(self, thread, fmt, concurrency=1, pacer=None, dry_run=None):
+        self.thread = thread
+        self.format = fmt
+        self.concurrency = max(1, int(concurrency))
+        self.pacer = pacer
+        self.dry_run = dry_run
+        self.lock = threading.Lock()
+        self.rendered = 0
+        self.posted = 0
+        self.failed = 0
+
+    def render(self, summaries):
+        """Render a block of summaries, all at once."""
+        records = [s.record(self.thread.unit_system) for s in summaries]
+        # every summary record has the same keys, in the same order
+        columns = dict((k, [r[k] for r in records]) for k in records[0])
+        with self.thread.stage('render'):
+            return self.thread.format_batch(columns, self.format)
+
+    def post(self, stop_ts, msg):
+        if self.pacer is not None:
+            self.pacer.wait()
+        try:
+            self.thread.post_with_retries(msg, media=False)
+        except (weewx.restx.FailedPost, weewx.restx.AbortedPost) as e:
+            logerr("summary to %s failed: %s" % (
+                   time.strftime('%Y-%m-%d %H:%M', time.localtime(stop_ts)),
+                   e))
+            self.thread.metrics.inc('post_failures')
+            with self.lock:
+                self.failed += 1
+            return
+        with self.lock:
+            self.posted += 1
+
+    def write(self, stop_ts, msg):
+        name = time.strftime('toot-%Y%m%d-%H%M.txt', time.localtime(stop_ts))
+        with open(os.path.join(self.dry_run, name), 'w') as f:
+            f.write(msg)
+
+    def blocks(self, summaries):
+        """The summaries in lists of up to RENDER_BLOCK."""
+        block = []
+        for summary in summaries:
+            block.append(summary)
+            if len(block) == RENDER_BLOCK:
+                yield block
+                block = []
+        if block:
+            yield block
+
+    def run(self, summaries):
+        # at most 2 rendered toots wait for each worker, however long the
+        # date range
+        slots = threading.BoundedSemaphore(self.concurrency * 2)
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.concurrency) as pool:
+            for block in self.blocks(summaries):
+                for summary, msg in zip(block, self.render(block)):
+                    self.rendered += 1
+                    if self.dry_run:
+                        self.write(summary.stop_ts, msg)
+                        continue
+                    if self.thread.skip_upload:
+                        loginf('skipping upload')
+                        continue
+                    slots.acquire()
+                    future = pool.submit(self.post, summary.stop_ts, msg)
+                    future.add_done_callback(lambda f: slots.release())
+        self.thread.metrics.export()
+
+
+def parse_date(text):
+    return datetime.datetime.strptime(text, '%Y-%m-%d').date()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Toot daily summaries for past days from the archive")
+    parser.add_argument('config_path', nargs='?',
+                        help="weewx.conf (default: the usual places)")
+    parser.add_argument('--from', dest='first', type=parse_date,
+                        required=True, metavar='YYYY-MM-DD',
+                        help="first day to summarise")
+    parser.add_argument('--to', dest='last', type=parse_date,
+                        metavar='YYYY-MM-DD',
+                        help="last day to summarise (default --from)")
+    parser.add_argument('--hour', type=int, default=9,
+                        help="the summaries run from this hour the day "
+                             "before to this hour on the day (default 9)")
+    parser.add_argument('--binding', default='wx_binding',
+                        help="database binding (default wx_binding)")
+    parser.add_argument('--format',
+                        help="toot format, with obstype_min, _max, _avg, "
+                             "_sum, _mintime and _maxtime placeholders")
+    parser.add_argument('--format-file', metavar='FILE',
+                        help="read the toot format from FILE")
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help="posts in flight at once (default 1)")
+    parser.add_argument('--rate', type=float, default=0,
+                        help="posts per minute at most (default no limit)")
+    parser.add_argument('--reserve', type=int, default=10,
+                        help="wait for the rate limit to reset when fewer "
+                             "than this many requests are left (default 10)")
+    parser.add_argument('--dry-run', metavar='DIR',
+                        help="write the toots to DIR, post nothing")
+    args = parser.parse_args()
+
+    if not 0 <= args.hour <= 23:
+        parser.error("--hour must be 0 to 23")
+    last = args.last or args.first
+    if last < args.first:
+        parser.error("--to is before --from")
+
+    config_path, config_dict = weecfg.read_config(args.config_path)
+    weeutil.logger.setup('tootbackfill', config_dict)
+
+    site_dict = wxtoot.Toot.get_toot_dict(config_dict)
+    if site_dict is None:
+        sys.exit("the [StdRESTful] [[Mastodon]] section of %s is incomplete"
+                 % config_path)
+    # the service options that mean nothing here
+    site_dict.pop('binding', None)
+    site_dict.pop('data_binding', None)
+    site_dict.pop('manager_dict', None)
+    thread = wxtoot.TootThread(None, **site_dict)
+
+    if args.format_file:
+        with open(args.format_file) as f:
+            fmt = f.read().replace("\\n", "\n")
+    else:
+        fmt = args.format or DEFAULT_FORMAT
+    obs_types = summary_types(fmt)
+
+    if args.dry_run and not os.path.isdir(args.dry_run):
+        os.makedirs(args.dry_run)
+    pacer = None if args.dry_run else Pacer(thread.mstdn, args.rate,
+                                            args.reserve)
+    backfill = Backfill(thread, fmt, args.concurrency, pacer, args.dry_run)
+
+    windows = list(day_windows(args.first, last, args.hour))
+    start = time.time()
+    with weewx.manager.open_manager_with_config(config_dict,
+                                                args.binding) as dbmanager:
+        records = gen_records(dbmanager, windows[0][0], windows[-1][1])
+        nrecs = [0]
+
+        def tally(records):
+            for record in records:
+                nrecs[0] += 1
+                yield record
+        backfill.run(gen_summaries(tally(records), windows, obs_types,
+                                   thread.unit_system))
+    elapsed = time.time() - start
+
+    print("%d archive records, %d days, %d summaries rendered, %s" % (
+          nrecs[0], len(windows), backfill.rendered,
+          "written to %s" % args.dry_run if args.dry_run else
+          "%d posted, %d failed" % (backfill.posted, backfill.failed)))
+    print("%.2f seconds, %.0f records/s, %.2f summaries/s%s" % (
+          elapsed, nrecs[0] / elapsed if elapsed else 0,
+          backfill.rendered / elapsed if elapsed else 0,
+          ", %.1f worker seconds waiting on the rate limit" % pacer.waited
+          if pacer else ''))
+    if backfill.failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
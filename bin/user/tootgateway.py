@@ -0,0 +1,473 @@
+#!/usr/bin/python3
+# A shared Mastodon gateway for the wxtoot services of many weewx stations
+#
+# Distributed under the terms of the GNU Public License (GPLv3)
+
+"""
+One process that does the Mastodon posting for every weewx instance on a
+host. Each wxtoot service with
+
+[StdRESTful]
+    [[Mastodon]]
+        gateway_socket = /run/wxtoot/gateway.sock
+
+renders its toots as usual but, instead of talking to the Mastodon server
+itself, sends each one (text, visibility, image file paths and in memory
+charts) over the Unix socket, and waits for the outcome. The gateway:
+
+  pools one Mastodon client, and so one keep-alive connection, for each
+  server and access token, however many stations use it
+
+  reads each image file once while its path, mtime and size are unchanged,
+  and uploads identical content once per account until it is attached to a
+  status, so a retried post does not upload its images again (Mastodon will
+  not attach one media id to a second status, so that is as far as sharing
+  can go)
+
+  queues the posts of each station separately and takes them in turn, round
+  robin, so a busy or slow station can not starve the others
+
+  spends a global budget of --rate posts a minute (with bursts of up to
+  --burst) across all stations, and leaves Mastodon.py to wait out any rate
+  limit the server reports
+
+  posts each idempotency key once: a station that gave up waiting and sent
+  the post again is given the outcome of the first one, still queued, in
+  flight or done, and the key goes on to status_post
+
+  answers limits requests with the posting limits of the server, cached for
+  an hour, so the stations split toots and size images as they would
+  talking to the server themselves
+
+Run it as a user that can read the image directories of every station, eg:
+
+    python3 -m user.tootgateway --socket /run/wxtoot/gateway.sock \\
+        --mode 0660 --rate 20 --burst 5 --workers 4
+
+The socket is the only access control, and the requests carry access tokens,
+so keep it in a directory (or with a --mode) that only the weewx users can
+reach.
+
+The protocol is one JSON object per line, each way, one request per
+connection:
+
+    {"station": "...", "server": "https://...", "token": "...",
+     "status": "...", "visibility": "unlisted", "in_reply_to_id": null,
+     "idempotency_key": "...",
+     "media": [{"path": "/var/www/html/weewx/daytempdew.png"},
+               {"name": "chart-outTemp.png", "mime": "image/png",
+                "data": "<base64>"}]}
+
+    {"ok": true, "id": "1234", "uploaded": 1, "reused": 1}
+    {"ok": false, "error": "..."}
+
+and for the limits:
+
+    {"limits": true, "server": "https://...", "token": "..."}
+
+    {"ok": true, "instance": {"max_toot_chars": null, "configuration":
+     {"statuses": {...}, "media_attachments": {...}}}}
+"""
+
+import argparse
+import base64
+import collections
+import hashlib
+import io
+import json
+import logging
+import mimetypes
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+from mastodon import Mastodon
+
+log = logging.getLogger('tootgateway')
+
+# servers delete media that is not attached to a status, after a day by
+# default, so an upload is only reused within this many seconds
+UNATTACHED_TTL = 3600
+# how long the outcome of a post is kept for a repeat of its idempotency
+# key, the time Mastodon itself keeps the keys
+IDEMPOTENT_TTL = 3600
+# how long the instance limits are kept
+INSTANCE_TTL = 3600
+
+
+def loginf(msg):
+    log.info(msg)
+
+
+def logerr(msg):
+    log.error(msg)
+
+
+def instance_subset(instance):
+    """The part of an instance() response that holds the posting limits, as
+    wxtoot.instance_limits reads them, and that goes into JSON."""
+    config = instance.get('configuration') or {}
+    return {'max_toot_chars': instance.get('max_toot_chars'),
+            'configuration': {
+                'statuses': dict(config.get('statuses') or {}),
+                'media_attachments': dict(
+                    config.get('media_attachments') or {})}}
+
+
+class TokenBucket(object):
+    """The global budget, 'rate' posts a minute with bursts of 'burst'."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate / 60.0
+        self.burst = float(max(1, burst))
+        self.tokens = self.burst
+        self.stamp = time.time()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """Block until a post may go, return the seconds waited."""
+        if not self.rate:
+            return 0.0
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens +
+                                  (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return waited
+                delay = (1.0 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class FileCache(object):
+    """The content, and its digest, of recently read image files, keyed by
+    (path, mtime, size) so a changed file is read again."""
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path):
+        st = os.stat(path)
+        key = (path, st.st_mtime, st.st_size)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+        with open(path, 'rb') as f:
+            data = f.read()
+        entry = (hashlib.sha1(data).hexdigest(), data)
+        with self.lock:
+            self.misses += 1
+            if key not in self.entries:
+                self.entries[key] = entry
+                self.size += len(data)
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                _, (_, old) = self.entries.popitem(last=False)
+                self.size -= len(old)
+        return entry
+
+
+class Account(object):
+    """The pooled client for one server and access token, and the media it
+    has uploaded that is not yet attached to a status."""
+
+    def __init__(self, server, token, timeout):
+        self.server = server
+        self.mstdn = Mastodon(access_token=token, api_base_url=server,
+                              request_timeout=timeout,
+                              ratelimit_method='wait')
+        # one post at a time per account, the rate limit is per account
+        self.lock = threading.Lock()
+        # content digest -> (media id, upload time)
+        self.unattached = {}
+        self.instance = None
+        self.instance_ts = 0
+
+
+class Job(object):
+    """A post waiting its turn, and then its reply."""
+
+    def __init__(self, request):
+        self.request = request
+        self.station = request.get('station') or '?'
+        self.key = request.get('idempotency_key')
+        self.queued = time.time()
+        self.finished = None
+        self.reply = None
+        self.done = threading.Event()
+
+
+class Gateway(object):
+    """Per station queues, taken round robin by a pool of workers."""
+
+    def __init__(self, rate=0, burst=1, workers=4, timeout=60,
+                 cache_bytes=64 * 1024 * 1024):
+        self.bucket = TokenBucket(rate, burst)
+        self.files = FileCache(cache_bytes)
+        self.timeout = timeout
+        self.accounts = {}
+        self.accounts_lock = threading.Lock()
+        # (server, token) -> the lock held while its client is built
+        self.account_locks = {}
+        self.queues = {}
+        # idempotency key -> its job, queued, in flight or recently done
+        self.keyed = {}
+        # stations with queued posts, in the order they are served
+        self.turns = collections.deque()
+        self.cond = threading.Condition()
+        self.stats = collections.Counter()
+        self.workers = [threading.Thread(target=self.work,
+                                         name='tootgateway-%d' % i)
+                        for i in range(max(1, workers))]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    def submit(self, request):
+        """Queue a post and return its job, or the job already made for its
+        idempotency key."""
+        job = Job(request)
+        with self.cond:
+            if job.key is not None:
+                now = time.time()
+                for key, old in list(self.keyed.items()):
+                    if old.finished is not None and \
+                       now - old.finished > IDEMPOTENT_TTL:
+                        del self.keyed[key]
+                if job.key in self.keyed:
+                    self.stats['repeats'] += 1
+                    return self.keyed[job.key]
+                self.keyed[job.key] = job
+            if job.station not in self.queues:
+                self.queues[job.station] = collections.deque()
+            if not self.queues[job.station]:
+                self.turns.append(job.station)
+            self.queues[job.station].append(job)
+            self.cond.notify()
+        return job
+
+    def next_job(self):
+        with self.cond:
+            while not self.turns:
+                self.cond.wait()
+            station = self.turns.popleft()
+            job = self.queues[station].popleft()
+            if self.queues[station]:
+                # back of the line, behind every other waiting station
+                self.turns.append(station)
+            return job
+
+    def work(self):
+        while True:
+            job = self.next_job()
+            self.bucket.take()
+            try:
+                job.reply = self.post(job.request)
+                self.stats['posts'] += 1
+            except Exception as e:
+                self.stats['failures'] += 1
+                logerr("%s: post failed: %s" % (job.station, e))
+                job.reply = {'ok': False, 'error': str(e)}
+            loginf("%s: %s after %.1f seconds" % (
+                   job.station, 'posted' if job.reply['ok'] else 'failed',
+                   time.time() - job.queued))
+            with self.cond:
+                job.finished = time.time()
+                if not job.reply['ok'] and job.key is not None:
+                    # a failure is for the station to retry, not to repeat
+                    self.keyed.pop(job.key, None)
+            job.done.set()
+
+    def account(self, server, token):
+        key = (server, token)
+        with self.accounts_lock:
+            if key in self.accounts:
+                return self.accounts[key]
+            key_lock = self.account_locks.setdefault(key, threading.Lock())
+        # building the client can go to the server, so only requests for
+        # this account wait on it, and a failure is retried next request
+        with key_lock:
+            with self.accounts_lock:
+                if key in self.accounts:
+                    return self.accounts[key]
+            account = Account(server, token, self.timeout)
+            with self.accounts_lock:
+                self.accounts[key] = account
+            return account
+
+    def limits(self, request):
+        """The posting limits of the server, for a limits request."""
+        account = self.account(request['server'], request['token'])
+        if account.instance is None or \
+           time.time() - account.instance_ts > INSTANCE_TTL:
+            account.instance = instance_subset(account.mstdn.instance())
+            account.instance_ts = time.time()
+        return {'ok': True, 'instance': account.instance}
+
+    def media_content(self, media):
+        """(digest, bytes, mime_type, file_name) of a media reference."""
+        if 'path' in media:
+            digest, data = self.files.get(media['path'])
+            return (digest, data, mimetypes.guess_type(media['path'])[0],
+                    os.path.basename(media['path']))
+        data = base64.b64decode(media['data'])
+        return (hashlib.sha1(data).hexdigest(), data,
+                media.get('mime', 'image/png'), media.get('name'))
+
+    def post(self, request):
+        account = self.account(request['server'], request['token'])
+        contents = [self.media_content(m) for m in request.get('media', [])]
+        with account.lock:
+            media_ids = []
+            uploaded = reused = 0
+            for digest, data, mime_type, file_name in contents:
+                media_id, uploaded_ts = account.unattached.get(digest,
+                                                               (None, 0))
+                if media_id is not None and \
+                   time.time() - uploaded_ts < UNATTACHED_TTL:
+                    reused += 1
+                else:
+                    media_id = account.mstdn.media_post(
+                        io.BytesIO(data), mime_type=mime_type,
+                        file_name=file_name)
+                    account.unattached[digest] = (media_id, time.time())
+                    uploaded += 1
+                    self.stats['upload_bytes'] += len(data)
+                if media_id not in media_ids:
+                    media_ids.append(media_id)
+            kwargs = {'visibility': request.get('visibility'),
+                      'in_reply_to_id': request.get('in_reply_to_id'),
+                      'idempotency_key': request.get('idempotency_key')}
+            if media_ids:
+                kwargs['media_ids'] = media_ids
+                kwargs['sensitive'] = False
+            status = account.mstdn.status_post(request['status'], **kwargs)
+            # attached now, so no use to another status
+            for digest, _, _, _ in contents:
+                account.unattached.pop(digest, None)
+        self.stats['uploaded'] += uploaded
+        self.stats['reused'] += reused
+        return {'ok': True, 'id': str(status['id']), 'uploaded': uploaded,
+                'reused': reused}
+
+
+class Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            request = json.loads(line.decode('utf-8'))
+            for key in ('server', 'token') if request.get('limits') else \
+                    ('server', 'token', 'status'):
+                if not request.get(key):
+                    raise ValueError("no %s" % key)
+        except ValueError as e:
+            self.send({'ok': False, 'error': 'bad request: %s' % e})
+            return
+        if request.get('limits'):
+            try:
+                self.send(self.server.gateway.limits(request))
+            except Exception as e:
+                logerr("unable to fetch the instance limits: %s" % e)
+                self.send({'ok': False, 'error': str(e)})
+            return
+        job = self.server.gateway.submit(request)
+        job.done.wait()
+        self.send(job.reply)
+
+    def send(self, reply):
+        try:
+            self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+        except (IOError, OSError) as e:
+            # the station gave up waiting
+            logerr("unable to reply: %s" % e)
+
+
+class GatewayServer(socketserver.ThreadingMixIn,
+                    socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(path, gateway, mode=None):
+    """Listen on the Unix socket 'path' until interrupted."""
+    if os.path.exists(path):
+        # a stale socket from an earlier run, unless one is still listening
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except (IOError, OSError):
+            os.unlink(path)
+        else:
+            raise SystemExit("%s is in use by another gateway" % path)
+        finally:
+            probe.close()
+    server = GatewayServer(path, Handler)
+    server.gateway = gateway
+    if mode is not None:
+        os.chmod(path, mode)
+    loginf("listening on %s" % path)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Shared Mastodon gateway for wxtoot services")
+    parser.add_argument('--socket', default='/run/wxtoot/gateway.sock',
+                        help="Unix socket to listen on "
+                             "(default /run/wxtoot/gateway.sock)")
+    parser.add_argument('--mode', type=lambda x: int(x, 8), default=None,
+                        help="permissions for the socket, eg 0660")
+    parser.add_argument('--rate', type=float, default=30,
+                        help="posts a minute, over all stations (default 30,"
+                             " 0 for no limit)")
+    parser.add_argument('--burst', type=int, default=5,
+                        help="posts that may go at once after a quiet spell"
+                             " (default 5)")
+    parser.add_argument('--workers', type=int, default=4,
+                        help="posts in flight at once (default 4)")
+    parser.add_argument('--timeout', type=float, default=60,
+                        help="Mastodon request timeout, seconds (default 60)")
+    parser.add_argument('--cache-mb', type=float, default=64,
+                        help="image file cache, MB (default 64)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='tootgateway: %(levelname)s %(message)s')
+    gateway = Gateway(args.rate, args.burst, args.workers, args.timeout,
+                      int(args.cache_mb * 1024 * 1024))
+    # stop cleanly, and remove the socket, when the service manager says so
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        serve(args.socket, gateway, args.mode)
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    loginf("stats %s, file cache %d hits %d misses" % (
+           dict(gateway.stats), gateway.files.hits, gateway.files.misses))
+
+
+if __name__ == '__main__':
+    main()
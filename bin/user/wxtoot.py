@@ -121,6 +121,93 @@ The dateTime field is handled slightly differently.  For example:
     ts: {dateTime:%X}           ->  ts: 16:07:50 22 Oct 2014
     ts: {dateTime:%H:%M:%S}     ->  ts: 16:07:50
 
+Alerts. Waiting for the next post_interval is too slow to warn of a severe
+gust or a rain burst. Rules placed under an [[[Alerts]]] section are checked
+against every LOOP packet and, when one triggers, a toot is queued ahead of
+the routine posts and sent without waiting for the post_interval. For example:
+
+[StdRESTful]
+    [[Mastodon]]
+        [[[Alerts]]]
+            [[[[gust]]]]
+                observation = windGust
+                above = 20.0
+                hysteresis = 3.0
+                cooldown = 1800
+            [[[[burst]]]]
+                observation = rainRate
+                above = 50.0
+                sustain = 120
+                format = {station:%s}: Heavy rain {rainRate:%.1f}
+
+Thresholds are in the units of the LOOP packet (the station units), not those
+of unit_system. The options for each rule are:
+
+    observation: the LOOP packet field to watch (required)
+    above, below: fire when the value is above / below this threshold
+    rate: fire when the value changes by this much (negative for a fall)
+          within rate_period seconds (default 300)
+    sustain: the condition must hold for this many seconds (default 0)
+    hysteresis: once fired, the value must drop back past the threshold by
+                this much before the rule can fire again (default 0)
+    cooldown: minimum seconds between toots from this rule (default 3600)
+    format: the toot format, as for 'format' above. {alert} is the rule name
+
+If more than one test is given they must all be met for the rule to fire.
+
+Feeds. One service can post several feeds, eg the indoor sensors, a second
+station database or a secondary sensor binding, each a subsection of
+[[[Feeds]]]. A feed takes the [[Mastodon]] options, then overrides any of
+station (default the feed name), binding, format, format_choice,
+template_file, images, image_directory, server_url_image, charts and
+post_interval. A feed with a data_binding posts the latest record in that
+database, at each archive record (or LOOP packet), otherwise it posts the
+weewx record itself. For example:
+
+[StdRESTful]
+    [[Mastodon]]
+        [[[Feeds]]]
+            [[[[indoor]]]]
+                format = {station:%s}: inside {inTemp:%.1f}
+                post_interval = 10800
+            [[[[shed]]]]
+                data_binding = shed_binding
+                format_choice = simple
+                charts = outTemp
+
+The feeds share the one thread, Mastodon client (and connection), limits,
+metrics and image cache (an image server fetch is reused for 60 seconds and
+a directory scan until the directory changes). Their databases are opened
+when first needed. With binding = none the [[Mastodon]] section itself posts
+nothing and only the feeds do.
+
+Long toots. The server's limits (characters per status, images per status
+and image size) are fetched at startup and again every limits_ttl seconds
+(default 86400). A toot that is too long, typically from a template, is
+split at line breaks into a thread of replies, numbered (1/3) and so on,
+with the images spread over them. Images over the size limit are skipped.
+A toot that would need more than max_thread posts (default 4) is not sent
+at all:
+
+[StdRESTful]
+    [[Mastodon]]
+        #max_thread = 4
+        #limits_ttl = 86400
+
+Many stations on one host. Where several weewx instances toot from the same
+machine, tootgateway.py can do the posting for all of them, with one pooled
+connection per account, fair turns for each station and a shared rate budget.
+Start it (see tootgateway.py) then point each service at its socket:
+
+[StdRESTful]
+    [[Mastodon]]
+        gateway_socket = /run/wxtoot/gateway.sock
+        # seconds to wait for the gateway to post, queueing included
+        #gateway_timeout = 300
+
+The toots are still rendered, and retried, by each service. The instance
+limits are asked of the gateway.
+
 """
 
 try:
@@ -129,18 +216,27 @@ try:
 except ImportError:
     # Python 2
     import Queue as queue
+import base64
+import collections
+import cProfile
+import hashlib
+import io
+import json
 import os
 import re
+import socket
 import sys
+import threading
 import time
-import requests
 import shutil
 import glob
+import uuid
+import weedb
 import weewx
+import weewx.manager
 import weewx.restx
 import weewx.units
-from weeutil.weeutil import to_bool
-from mastodon import Mastodon
+from weeutil.weeutil import to_bool, to_float
 
 try:
     # Test for new-style weewx logging by trying to import weeutil.logger
@@ -181,6 +277,159 @@ if weewx.__version__ < "3":
                                    weewx.__version__)
 
 
+# Mastodon.py, and requests with it, are slow to import so they are only
+# imported when first needed, by the TootThread rather than at weewx startup
+Mastodon = None
+requests = None
+_import_lock = threading.Lock()
+
+
+def _import_client():
+    """Import Mastodon.py and requests, once. Return the Mastodon class."""
+    global Mastodon, requests
+    with _import_lock:
+        if Mastodon is None:
+            t0 = time.time()
+            import requests as _requests
+            from mastodon import Mastodon as _Mastodon
+            requests = _requests
+            Mastodon = _Mastodon
+            loginf("Mastodon.py and requests imported in %.3f seconds" % (
+                   time.time() - t0))
+    return Mastodon
+
+
+# Pillow is a weewx dependency, but only needed here for charts, so it is
+# imported when charts are configured. False once it is known to be missing
+Image = ImageDraw = ImageFont = None
+
+
+def _import_pil():
+    """Import Pillow, once. Return True if it is installed."""
+    global Image, ImageDraw, ImageFont
+    with _import_lock:
+        if Image is None:
+            try:
+                from PIL import Image as _Image, ImageDraw as _ImageDraw, \
+                    ImageFont as _ImageFont
+                Image, ImageDraw, ImageFont = _Image, _ImageDraw, _ImageFont
+            except ImportError:
+                Image = False
+    return bool(Image)
+
+
+# numpy is only for format_batch, which renders record by record without it,
+# so it is imported on first use too. False once it is known to be missing
+np = None
+
+
+def _import_numpy():
+    """Import numpy, once. Return it, or None if it is not installed."""
+    global np
+    with _import_lock:
+        if np is None:
+            try:
+                import numpy as _np
+                np = _np
+            except ImportError:
+                np = False
+    return np or None
+
+
+def instance_limits(instance):
+    """The posting limits from an instance() (v1 or v2) response, with the
+    Mastodon defaults for any the server does not give."""
+    config = instance.get('configuration') or {}
+    statuses = config.get('statuses') or {}
+    media = config.get('media_attachments') or {}
+    return {
+        'max_characters': int(statuses.get('max_characters') or
+                              instance.get('max_toot_chars') or 500),
+        'max_media': int(statuses.get('max_media_attachments') or 4),
+        'characters_reserved_per_url': int(
+            statuses.get('characters_reserved_per_url') or 23),
+        'image_size_limit': int(media.get('image_size_limit') or 0) or None,
+    }
+
+
+# Mastodon counts every URL as characters_reserved_per_url characters
+_URL_RE = re.compile(r'https?://\S+')
+# room left in each part of a split toot for its ' (n/m)'
+_PART_MARK = ' (99/99)'
+
+
+def toot_length(text, url_length=23):
+    """The length of text as Mastodon counts it."""
+    return len(_URL_RE.sub('x' * url_length, text))
+
+
+def split_toot(text, max_chars, url_length=23):
+    """Split text into parts of no more than max_chars, at line breaks where
+    it can, then at spaces, numbered ' (n/m)' if there is more than one."""
+    if toot_length(text, url_length) <= max_chars:
+        return [text]
+    room = max_chars - len(_PART_MARK)
+    # (separator, piece) pairs, each piece short enough for a part
+    pieces = []
+    for line in text.split('\n'):
+        sep = '\n'
+        if toot_length(line, url_length) <= room:
+            pieces.append((sep, line))
+            continue
+        for word in line.split(' '):
+            if toot_length(word, url_length) <= room:
+                pieces.append((sep, word))
+            else:
+                for i in range(0, len(word), room):
+                    pieces.append((sep if i == 0 else '', word[i:i + room]))
+            sep = ' '
+    parts = []
+    current = None
+    for sep, piece in pieces:
+        candidate = piece if current is None else current + sep + piece
+        if toot_length(candidate, url_length) <= room:
+            current = candidate
+        else:
+            parts.append(current)
+            current = piece
+    parts.append(current)
+    parts = [p for p in parts if p and p.strip()]
+    if len(parts) == 1:
+        return parts
+    return ['%s (%d/%d)' % (p, n + 1, len(parts)) for n, p in enumerate(parts)]
+
+
+# from mqtt.py
+UNIT_REDUCTIONS = {
+    'degree_F': 'F',
+    'degree_C': 'C',
+    'inch': 'in',
+    'mile_per_hour': 'mph',
+    'mile_per_hour2': 'mph',
+    'km_per_hour': 'kph',
+    'km_per_hour2': 'kph',
+    'meter_per_second': 'mps',
+    'meter_per_second2': 'mps',
+    'degree_compass': None,
+    'watt_per_meter_squared': 'Wpm2',
+    'uv_index': None,
+    'percent': '%',
+    'unix_epoch': None,
+}
+
+# summary records, as made by tootbackfill.py, carry aggregates named
+# obstype_aggregate, eg outTemp_max, in the units of the observation type
+AGGREGATE_SUFFIXES = ('_min', '_max', '_avg', '_sum')
+TIME_SUFFIXES = ('_mintime', '_maxtime')
+
+
+def _obs_type(obs):
+    """The observation type behind a (possibly aggregate) record key."""
+    if obs.endswith(AGGREGATE_SUFFIXES):
+        return obs.rsplit('_', 1)[0]
+    return obs
+
+
 def _format(label, fmt, datum):
     s = fmt % datum if datum is not None else "None"
     return "%s: %s" % (label, s)
@@ -194,6 +443,575 @@ def _dir_to_ord(x, ordinals):
     return ordinals[17]
 
 
+def _dir_to_ords(values, ordinals):
+    """_dir_to_ord over a column of directions, as one index into ordinals.
+    None stays None."""
+    np = _import_numpy()
+    if np is None or not all(v is None or type(v) in (float, int)
+                             for v in values):
+        return [None if v is None else _dir_to_ord(v, ordinals)
+                for v in values]
+    x = np.array([np.nan if v is None else v for v in values], dtype=float)
+    with np.errstate(invalid='ignore'):
+        idx = np.rint(x / 22.5)
+    # negative indices wrap, as they do into the list, NaN is never valid
+    n = len(ordinals)
+    valid = (idx >= -n) & (idx < n)
+    names = np.empty(len(values), dtype=object)
+    names[valid] = np.array(ordinals, dtype=object)[
+        idx[valid].astype(int) % n]
+    names = names.tolist()
+    # None, NaN, infinite and out of range, one by one
+    for i in np.flatnonzero(~valid).tolist():
+        if values[i] is not None:
+            names[i] = _dir_to_ord(values[i], ordinals)
+    return names
+
+
+def _conversion(obs, from_system, unit_system):
+    """The function to_std_system converts obs with, from one unit system to
+    another, or None if it leaves obs as it is."""
+    (from_unit, group) = weewx.units.StdUnitConverters[
+        from_system].getTargetUnit(obs)
+    if from_unit is None and group is None:
+        return None
+    # the same lookups, and KeyErrors, as Converter.convert
+    to_unit = weewx.units.StdUnitConverters[unit_system].convert(
+        weewx.units.ValueTuple(None, from_unit, group))[1]
+    if to_unit == from_unit:
+        return None
+    return weewx.units.conversionDict[from_unit][to_unit]
+
+
+def _convert_column(values, groups, funcs):
+    """Convert a column, the rows in groups[system] with funcs[system].
+
+    Floats are converted a whole array at a time, with the very function
+    to_std_system would call on each, so the results are the same to the
+    last bit. Anything else, or a function that does not take arrays, goes
+    value by value.
+    """
+    np = _import_numpy()
+    out = list(values)
+    for system, rows in groups.items():
+        func = funcs[system]
+        if func is None:
+            continue
+        rows = [i for i in rows if values[i] is not None]
+        if not rows:
+            continue
+        column = [values[i] for i in rows]
+        converted = None
+        if np is not None and all(type(v) is float for v in column):
+            try:
+                # where numpy would warn, python may raise, so ask python
+                with np.errstate(all='raise'):
+                    result = func(np.array(column))
+                if isinstance(result, np.ndarray) and \
+                   result.dtype == np.float64 and \
+                   result.shape == (len(column),):
+                    converted = result.tolist()
+            except (TypeError, ValueError, ArithmeticError):
+                pass
+        if converted is None:
+            converted = [func(v) for v in column]
+        for i, v in zip(rows, converted):
+            out[i] = v
+    return out
+
+
+_KEY_RE = re.compile(r'\w+$')
+
+
+def _plan_format(msg, keys):
+    """Find, once, the placeholders format_toot would replace in msg.
+
+    Returns the (key, fmt) of each placeholder found, and msg as a
+    %-template with a %s for each occurrence and the index of its
+    placeholder for each %s. Returns None where what format_toot does
+    could depend on the text it inserts: a key that is not a plain name, a
+    format with braces in it, or a placeholder inside other braces.
+    """
+    found = []
+    for obs in keys:
+        if not _KEY_RE.match(obs):
+            return None
+        fmt = '%s'
+        m = re.search("{%s}" % obs, msg)
+        if m is None:
+            m = re.search("{%s:([^}]+)}" % obs, msg)
+            if m is None:
+                continue
+            fmt = m.group(1)
+            if '{' in fmt:
+                return None
+        found.append((obs, fmt, m.group(0)))
+    pieces = [msg]
+    for n, (_, _, oldstr) in enumerate(found):
+        split = []
+        for piece in pieces:
+            if isinstance(piece, int):
+                split.append(piece)
+                continue
+            for j, text in enumerate(piece.split(oldstr)):
+                if j:
+                    split.append(n)
+                split.append(text)
+        pieces = split
+    literal = ''.join('\0' if isinstance(p, int) else p for p in pieces)
+    if '\0' in msg or re.search('{[^}]*\0', literal):
+        return None
+    template = ''.join('%s' if isinstance(p, int) else p.replace('%', '%%')
+                       for p in pieces)
+    slots = [p for p in pieces if isinstance(p, int)]
+    return [(obs, fmt) for obs, fmt, _ in found], template, slots
+
+
+# drawn chart sets kept, a window for the service and each feed with charts
+CHART_CACHE_SIZE = 8
+
+
+def _render_chart(obs, times, values, unit, width, height):
+    """Draw a compact line chart of values against times, return PNG bytes.
+
+    Each unbroken run of values is drawn with a single polyline call; gaps
+    (None) break the line.
+    """
+    if not _import_pil():
+        raise ImportError("charts need the python Pillow (PIL) module")
+    im = Image.new('RGB', (width, height), (255, 255, 255))
+    draw = ImageDraw.Draw(im)
+    font = ImageFont.load_default()
+    good = [v for v in values if v is not None]
+    if good:
+        lo = min(good)
+        hi = max(good)
+        title = '%s  %.1f  (%.1f - %.1f) %s' % (obs, good[-1], lo, hi,
+                                                unit or '')
+    else:
+        lo = hi = 0.0
+        title = '%s  no data' % obs
+    draw.text((4, 2), title, fill=(0, 0, 0), font=font)
+
+    top = 16
+    span_v = (hi - lo) or 1.0
+    span_t = (times[-1] - times[0]) or 1.0
+    x_scale = (width - 9) / span_t
+    y_scale = (height - top - 5) / span_v
+    draw.rectangle((0, top - 2, width - 1, height - 1), outline=(180, 180, 180))
+    points = []
+    for t, v in zip(times, values):
+        if v is None:
+            if len(points) > 1:
+                draw.line(points, fill=(200, 30, 30), width=2)
+            points = []
+            continue
+        points.append((4 + (t - times[0]) * x_scale,
+                       height - 3 - (v - lo) * y_scale))
+    if len(points) > 1:
+        draw.line(points, fill=(200, 30, 30), width=2)
+
+    buf = io.BytesIO()
+    im.save(buf, format='PNG', optimize=True)
+    return buf.getvalue()
+
+
+def gateway_request(path, request, timeout):
+    """Send one request to the tootgateway.py listening on the Unix socket
+    'path' and return its reply."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        reply = sock.makefile('rb').readline()
+    finally:
+        sock.close()
+    if not reply:
+        raise IOError("no reply")
+    return json.loads(reply.decode('utf-8'))
+
+
+class TootQueue(queue.Queue):
+    """A FIFO queue that hands out alert records ahead of routine records.
+
+    RESTThread only passes the timestamp to skip_this_post, so the item most
+    recently taken from the queue is kept in 'current' for the consumer.
+    """
+
+    def _init(self, maxsize):
+        queue.Queue._init(self, maxsize)
+        self.alerts = collections.deque()
+        self.current = None
+
+    def _qsize(self):
+        return len(self.queue) + len(self.alerts)
+
+    def _put(self, item):
+        if item is not None and item.get('binding') == 'alert':
+            self.alerts.append(item)
+        else:
+            self.queue.append(item)
+
+    def _get(self):
+        if self.alerts:
+            self.current = self.alerts.popleft()
+        else:
+            self.current = self.queue.popleft()
+        return self.current
+
+
+class ImageCache(object):
+    """Image server fetches and image directory scans, shared by the feeds
+    of a service. A fetch is reused for max_age seconds, so feeds posting
+    for the same record fetch a shared image once. A scan is reused for as
+    long as the directory is unchanged."""
+
+    def __init__(self, max_age=60):
+        self.max_age = max_age
+        self.fetches = {}
+        self.scans = {}
+
+    def fetch(self, url, path):
+        """Fetch url to the file path, unless that was done lately. Return
+        the HTTP status."""
+        key = (url, path)
+        hit = self.fetches.get(key)
+        if hit is not None and time.time() - hit[0] < self.max_age and \
+           os.path.isfile(path):
+            return hit[1]
+        _import_client()
+        image = requests.get(url, stream=True)
+        if image.status_code == 200:
+            # Set decode_content value to True, otherwise the
+            # downloaded image file's size will be zero.
+            image.raw.decode_content = True
+        with open(path, 'wb') as f:
+            shutil.copyfileobj(image.raw, f)
+        self.fetches[key] = (time.time(), image.status_code)
+        return image.status_code
+
+    def scan(self, directory):
+        """The png, jpg, gif and webp files in directory."""
+        try:
+            mtime = os.stat(directory).st_mtime
+        except OSError:
+            return []
+        hit = self.scans.get(directory)
+        if hit is not None and hit[0] == mtime:
+            return hit[1]
+        found = [imgs for imgs in glob.iglob(f'{directory}/*')
+                 if imgs.endswith(('.png', '.jpg', '.gif', '.webp'))]
+        self.scans[directory] = (mtime, found)
+        return found
+
+
+class AlertRule(object):
+    """A threshold / rate of change rule, checked against LOOP packets.
+
+    check() is called on the engine thread for every LOOP packet, so it does
+    no more than a few comparisons unless 'rate' is in use.
+    """
+
+    def __init__(self, name, observation, above=None, below=None, rate=None,
+                 rate_period=300, sustain=0, hysteresis=0, cooldown=3600,
+                 format=None):
+        self.name = name
+        self.observation = observation
+        self.above = to_float(above)
+        self.below = to_float(below)
+        self.rate = to_float(rate)
+        self.rate_period = to_float(rate_period)
+        self.sustain = to_float(sustain)
+        self.hysteresis = to_float(hysteresis)
+        self.cooldown = to_float(cooldown)
+        if self.above is None and self.below is None and self.rate is None:
+            # with nothing to test, every packet would fire it
+            raise ValueError("no above, below or rate given")
+        if format is None:
+            format = '{station:%%s}: {alert} alert, %s {%s:%%.1f} ' \
+                     'at {dateTime:%%H:%%M}' % (observation, observation)
+        self.format = format
+        # (dateTime, value) pairs within rate_period, oldest first
+        self.history = collections.deque()
+        self.since = None
+        self.last_fired = None
+        self.armed = True
+
+    def check(self, value, ts):
+        """Return True if this rule fires for 'value' at time 'ts'."""
+        met = True
+        if self.above is not None:
+            met = value > self.above
+        if met and self.below is not None:
+            met = value < self.below
+        if self.rate is not None:
+            self.history.append((ts, value))
+            while self.history[0][0] < ts - self.rate_period:
+                self.history.popleft()
+            delta = value - self.history[0][1]
+            if met:
+                if self.rate < 0:
+                    met = delta <= self.rate
+                else:
+                    met = delta >= self.rate
+
+        if not met:
+            self.since = None
+            if not self.armed and self._cleared(value):
+                self.armed = True
+            return False
+        if not self.armed:
+            return False
+        if self.since is None:
+            self.since = ts
+        if ts - self.since < self.sustain:
+            return False
+        if self.last_fired is not None and \
+           ts - self.last_fired < self.cooldown:
+            return False
+        self.armed = False
+        self.last_fired = ts
+        return True
+
+    def _cleared(self, value):
+        # has the value moved back past the threshold(s) by the hysteresis?
+        if self.above is not None and value > self.above - self.hysteresis:
+            return False
+        if self.below is not None and value < self.below + self.hysteresis:
+            return False
+        return True
+
+
+class _Stage(object):
+    """Times a 'with' block into a TootMetrics stage."""
+
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, etype, value, tb):
+        self.metrics.observe(self.name, time.time() - self.start)
+        return False
+
+
+class _NullStage(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, value, tb):
+        return False
+
+
+class _Span(object):
+    """Times a 'with' block into a TootMetrics stage and a TootTrace."""
+
+    def __init__(self, trace, metrics, name, attrs):
+        self.trace = trace
+        self.metrics = metrics
+        self.span = {'name': name, 'attrs': attrs}
+
+    def __enter__(self):
+        self.start = time.time()
+        self.span['start'] = round(self.start - self.trace.start, 6)
+        self.trace.open.append(self.span)
+        return self
+
+    def __exit__(self, etype, value, tb):
+        elapsed = time.time() - self.start
+        self.metrics.observe(self.span['name'], elapsed)
+        self.span['duration'] = round(elapsed, 6)
+        if etype is not None:
+            self.span['error'] = '%s: %s' % (etype.__name__, value)
+        self.trace.open.pop()
+        self.trace.spans.append(self.span)
+        return False
+
+
+class TootTrace(object):
+    """The trace of one sampled post: its spans, and their attributes."""
+
+    def __init__(self, station, record):
+        self.start = time.time()
+        self.attrs = {'station': station,
+                      'record_ts': record.get('dateTime'),
+                      'binding': record.get('binding')}
+        self.spans = []
+        # the spans not yet finished, innermost last
+        self.open = []
+
+    def annotate(self, key, value):
+        """Set an attribute on the innermost open span, or the trace."""
+        target = self.open[-1]['attrs'] if self.open else self.attrs
+        target[key] = value
+
+    def as_dict(self, outcome):
+        return {'start': self.start,
+                'duration': round(time.time() - self.start, 6),
+                'outcome': outcome,
+                'attrs': self.attrs,
+                'spans': sorted(self.spans, key=lambda x: x['start'])}
+
+
+class NullMetrics(object):
+    """Used when metrics are off, every call is a no-op."""
+
+    _STAGE = _NullStage()
+
+    def stage(self, name):
+        return self._STAGE
+
+    def observe(self, name, seconds):
+        pass
+
+    def inc(self, name, n=1):
+        pass
+
+    def set(self, name, value):
+        pass
+
+    def export(self):
+        pass
+
+
+class TootMetrics(NullMetrics):
+    """Stage timings and counters for TootThread.
+
+    Written to metrics_file, atomically, in the Prometheus text format (for
+    the node_exporter textfile collector) after each record, and/or served
+    from http://metrics_address:metrics_port/metrics
+    """
+
+    _COUNTERS = (
+        ('records_dropped_interval',
+         'Records skipped by post_interval (or as stale)'),
+        ('records_processed', 'Records taken from the queue and processed'),
+        ('posts', 'Successful status posts'),
+        ('post_failures', 'Records that failed to post'),
+        ('retries', 'Post retries'),
+        ('media_uploaded', 'Media uploaded'),
+        ('upload_bytes', 'Bytes of media uploaded'),
+        ('chart_cache_hits', 'Charts reused, not drawn again'),
+    )
+    _GAUGES = (
+        ('queue_depth', 'Records waiting in the queue'),
+        ('last_success_timestamp_seconds', 'Time of the last successful post'),
+    )
+
+    def __init__(self, station, metrics_file=None, metrics_port=None,
+                 metrics_address='127.0.0.1'):
+        self.labels = 'station="%s"' % str(station).replace('"', '\\"')
+        self.metrics_file = metrics_file
+        self.lock = threading.Lock()
+        # stage -> [count, total seconds, last seconds]
+        self.stages = {}
+        self.counters = dict((name, 0) for name, _ in self._COUNTERS)
+        self.gauges = dict((name, 0) for name, _ in self._GAUGES)
+        if metrics_port:
+            self._serve(metrics_address, int(metrics_port))
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    def observe(self, name, seconds):
+        with self.lock:
+            st = self.stages.get(name)
+            if st is None:
+                st = self.stages[name] = [0, 0.0, 0.0]
+            st[0] += 1
+            st[1] += seconds
+            st[2] = seconds
+
+    def inc(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def set(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def render(self):
+        """The metrics, in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            lines.append('# HELP wxtoot_stage_seconds Time spent in each '
+                         'stage of a post')
+            lines.append('# TYPE wxtoot_stage_seconds summary')
+            for name in sorted(self.stages):
+                st = self.stages[name]
+                lines.append('wxtoot_stage_seconds_sum{%s,stage="%s"} %.6f' %
+                             (self.labels, name, st[1]))
+                lines.append('wxtoot_stage_seconds_count{%s,stage="%s"} %d' %
+                             (self.labels, name, st[0]))
+            lines.append('# HELP wxtoot_stage_last_seconds Time taken by '
+                         'the latest run of each stage')
+            lines.append('# TYPE wxtoot_stage_last_seconds gauge')
+            for name in sorted(self.stages):
+                lines.append('wxtoot_stage_last_seconds{%s,stage="%s"} %.6f' %
+                             (self.labels, name, self.stages[name][2]))
+            for name, text in self._COUNTERS:
+                lines.append('# HELP wxtoot_%s_total %s' % (name, text))
+                lines.append('# TYPE wxtoot_%s_total counter' % name)
+                lines.append('wxtoot_%s_total{%s} %d' % (
+                             name, self.labels, self.counters[name]))
+            for name, text in self._GAUGES:
+                lines.append('# HELP wxtoot_%s %s' % (name, text))
+                lines.append('# TYPE wxtoot_%s gauge' % name)
+                lines.append('wxtoot_%s{%s} %s' % (
+                             name, self.labels, self.gauges[name]))
+        return '\n'.join(lines) + '\n'
+
+    def export(self):
+        """Write metrics_file, via a rename so it is never seen half
+        written."""
+        if not self.metrics_file:
+            return
+        tmp = '%s.%d.tmp' % (self.metrics_file, os.getpid())
+        try:
+            with open(tmp, 'w') as f:
+                f.write(self.render())
+            os.rename(tmp, self.metrics_file)
+        except (IOError, OSError) as e:
+            logerr("unable to write metrics file %s: %s" % (
+                   self.metrics_file, e))
+
+    def _serve(self, address, port):
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, fmt, *args):
+                pass
+
+        try:
+            server = HTTPServer((address, port), Handler)
+        except (IOError, OSError) as e:
+            logerr("unable to serve metrics on %s:%s: %s" % (address, port, e))
+            return
+        thread = threading.Thread(target=server.serve_forever,
+                                  name='wxtoot-metrics')
+        thread.daemon = True
+        thread.start()
+        loginf("metrics served on http://%s:%s/metrics" % (address, port))
+
+
 class Toot(weewx.restx.StdRESTbase):
 
     _DEFAULT_FORMAT_1 = '{station:%.8s}: Ws: {windSpeed:%.1f}; Wd:' \
@@ -270,10 +1088,181 @@ class Toot(weewx.restx.StdRESTbase):
         cardinal = False
           Wd: {windDir:%03.0f}        ->  Wd: 090
 
+        Alerts: a subsection of named rules checked against each LOOP packet.
+        See the notes at the top of this file.
+
+        charts: comma separated list of archive observations to draw as
+        charts and upload with each toot, eg charts = outTemp, windSpeed
+        The charts are drawn from the database (data_binding, default
+        wx_binding) and take the first image slots.
+        Default is no charts
+
+        chart_hours: how much history the charts show. Default is 24
+
+        chart_width, chart_height: chart size in pixels. Default is 400 x 150
+
+        metrics_file: write stage timings and counters to this file, in the
+        Prometheus text format, after each record (eg for the node_exporter
+        textfile collector). Default is no file
+
+        metrics_port: serve the same metrics on http://127.0.0.1:port/metrics
+        (metrics_address changes the listening address). Default is off
+
+        trace_sample: trace 1 in this many posts, recording each stage of
+        the post with its timing and details as one JSON line. Default is 0,
+        no tracing. Unlike dev_mode, the post itself is unchanged
+
+        trace_file: append the traces to this file. Default is the log
+
+        trace_profile_dir: also run the python profiler over each traced
+        post and save the pstats file here. Default is no profiling
+
         """
         super(Toot, self).__init__(engine, config_dict)
         loginf('service version is %s' % VERSION)
+        start_ts = time.time()
+
+        site_dict = self.get_toot_dict(config_dict)
+        if site_dict is None:
+            return
+
+        logdbg("site_dict is : %s" % site_dict)
+
+        loginf("toot visibility is %s " % site_dict['visibility'])
+
+        # we can bind to archive or loop events, default to archive
+        binding = site_dict.pop('binding', 'archive')
+        if isinstance(binding, list):
+            binding = ','.join(binding)
+        loginf('binding is %s' % binding)
+
+        # run some prechecks
+        # FIXME - probably too early, but they will be generated if allowed to
+        # continue - unless user intervention is truly required
+        """
+        self.template_file = site_dict.get('template_file')
+        if self.template_file:
+            if self.dev_mode:
+                loginf("template_file is %s" % self.template_file)
+            if not os.path.isfile(self.template_file):
+                logerr("Missing file? %s" % self.template_file)
+        self.templatesum_file = site_dict.get('template_last_file')
+        if self.templatesum_file:
+            if self.dev_mode:
+                loginf("templatesum_file is %s" % self.templatesum_file)
+            if not os.path.isfile(self.templatesum_file):
+                logerr("Missing summary file? %s" % self.templatesum_file)
+        """
+        self.image_directory = site_dict.get('image_directory')
+        if self.image_directory:
+            if os.path.isdir(self.image_directory):
+                pass
+            else:
+                logerr("Error accessing directory: %s" % self.image_directory)
+                return
+
+        # alert rules are a subsection, get_site_dict only returns the leaves
+        alerts_dict = config_dict['StdRESTful']['Mastodon'].get('Alerts')
+        self.alert_rules = []
+        for name in (alerts_dict.sections if alerts_dict else []):
+            try:
+                self.alert_rules.append(AlertRule(name, **alerts_dict[name]))
+            except (TypeError, ValueError) as e:
+                logerr("Skipping alert rule %s: %s" % (name, e))
+        if self.alert_rules:
+            loginf("alert rules are %s" % [r.name for r in self.alert_rules])
+
+        # more feeds, each with its own binding, format, images and schedule
+        feed_dicts = self.get_feed_dicts(config_dict, site_dict)
+        self.feed_bindings = {}
+        for name, feed_dict in feed_dicts.items():
+            feed_binding = feed_dict.pop('binding', 'archive')
+            if isinstance(feed_binding, list):
+                feed_binding = ','.join(feed_binding)
+            self.feed_bindings[name] = feed_binding.lower()
+            if feed_dict.get('charts') and not _import_pil():
+                logerr("feed %s: charts need the python Pillow (PIL) "
+                       "module, charts disabled" % name)
+                feed_dict['charts'] = ''
+            # a feed without a database of its own draws its charts from
+            # the service's
+            if feed_dict.get('charts') and 'manager_dict' not in feed_dict \
+               and 'manager_dict' not in site_dict:
+                site_dict['manager_dict'] = \
+                    weewx.manager.get_manager_dict_from_config(
+                        config_dict, config_dict['StdRESTful']['Mastodon'].get(
+                            'data_binding', 'wx_binding'))
+        if feed_dicts:
+            loginf("feeds are %s" % self.feed_bindings)
+
+        self.data_queue = TootQueue()
+        data_thread = TootThread(self.data_queue, feeds=feed_dicts,
+                                 **site_dict)
+        data_thread.start()
+
+        self.loop_feeds = [name for name, b in self.feed_bindings.items()
+                           if 'loop' in b]
+        self.archive_feeds = [name for name, b in self.feed_bindings.items()
+                              if 'archive' in b]
+        self.post_loop = 'loop' in binding.lower()
+        self.post_archive = 'archive' in binding.lower()
+        if self.post_loop or self.loop_feeds:
+            self.bind(weewx.NEW_LOOP_PACKET, self.handle_new_loop)
+        if self.alert_rules:
+            self.bind(weewx.NEW_LOOP_PACKET, self.handle_alert_loop)
+        if self.post_archive or self.archive_feeds:
+            self.bind(weewx.NEW_ARCHIVE_RECORD, self.handle_new_archive)
 
+        loginf("Data will be tooted for %s" % site_dict['station'])
+        loginf("service started in %.3f seconds" % (time.time() - start_ts))
+
+    @classmethod
+    def choice_format(cls, format_choice):
+        """The default format for a format_choice."""
+        if format_choice == 'simple':
+            return cls._DEFAULT_FORMAT_1
+        elif format_choice == 'full':
+            return cls._DEFAULT_FORMAT_2
+        elif format_choice == 'template':
+            return cls._DEFAULT_MISSING
+        return cls._DEFAULT_FORMAT_3
+
+    @classmethod
+    def get_feed_dicts(cls, config_dict, site_dict):
+        """Return the TootThread arguments for each [[[Feeds]]] subsection:
+        the service options, overridden by those of the feed."""
+        # feeds are a subsection, get_site_dict only returns the leaves
+        feeds_dict = config_dict['StdRESTful']['Mastodon'].get('Feeds')
+        feed_dicts = {}
+        for name in (feeds_dict.sections if feeds_dict else []):
+            options = feeds_dict[name]
+            feed_dict = dict(site_dict)
+            feed_dict.pop('manager_dict', None)
+            feed_dict['station'] = name
+            if 'format_choice' in options and 'format' not in options:
+                feed_dict['format'] = cls.choice_format(
+                    options['format_choice'])
+            feed_dict.update(options.dict())
+            # the same conversions get_toot_dict makes for the service
+            if 'cardinal' in options:
+                feed_dict['format_ordinal'] = to_bool(options['cardinal'])
+            for key in ('format_utc', 'dev_mode'):
+                if key in options:
+                    feed_dict[key] = to_bool(options[key])
+            if 'unit_system' in options:
+                feed_dict['unit_system'] = \
+                    weewx.units.unit_constants[options['unit_system'].upper()]
+            if feed_dict.get('data_binding'):
+                feed_dict['manager_dict'] = \
+                    weewx.manager.get_manager_dict_from_config(
+                        config_dict, feed_dict['data_binding'])
+            feed_dicts[name] = feed_dict
+        return feed_dicts
+
+    @classmethod
+    def get_toot_dict(cls, config_dict):
+        """Return the [[Mastodon]] options, with the defaults filled in, as
+        the keyword arguments for TootThread. None if they are incomplete."""
         site_dict = weewx.restx.get_site_dict(config_dict,
                                               'Mastodon',
                                               'key_access_token',
@@ -281,7 +1270,7 @@ class Toot(weewx.restx.StdRESTbase):
                                               )
         if site_dict is None:
             logerr("site_dict failed, is it complete? : %s" % site_dict)
-            return
+            return None
 
         # default the station name
         site_dict.setdefault('station', config_dict['Station']['location'])
@@ -295,28 +1284,35 @@ class Toot(weewx.restx.StdRESTbase):
         site_dict.setdefault('cardinal', True)
         site_dict['format_ordinal'] = to_bool(site_dict.get('cardinal'))
         site_dict.setdefault('format_choice', 'full')
-        if site_dict['format_choice'] == 'simple':
-            site_dict.setdefault('format', self._DEFAULT_FORMAT_1)
-        elif site_dict['format_choice'] == 'full':
-            site_dict.setdefault('format', self._DEFAULT_FORMAT_2)
-        elif site_dict['format_choice'] == 'template':
-            site_dict.setdefault('format', self._DEFAULT_MISSING)
-        else:
-            site_dict.setdefault('format', self._DEFAULT_FORMAT_3)
+        site_dict.setdefault('format',
+                             cls.choice_format(site_dict['format_choice']))
 
         site_dict.setdefault('server_url_image', '')
         site_dict.setdefault('image_directory', '')
         site_dict.setdefault('images', '')
         site_dict.setdefault('template_file', '')
         site_dict.setdefault('template_last_file', '')
-        site_dict.setdefault('format_None', self._DEFAULT_FORMAT_NONE)
+        site_dict.setdefault('format_None', cls._DEFAULT_FORMAT_NONE)
         site_dict.setdefault('format_utc', False)
         site_dict['format_utc'] = to_bool(site_dict.get('format_utc'))
-        site_dict.setdefault('ordinals', self._DEFAULT_ORDINALS)
+        site_dict.setdefault('ordinals', cls._DEFAULT_ORDINALS)
+        site_dict.setdefault('charts', '')
+        site_dict.setdefault('chart_hours', 24)
+        site_dict.setdefault('chart_width', 400)
+        site_dict.setdefault('chart_height', 150)
+        data_binding = site_dict.pop('data_binding', 'wx_binding')
+        if site_dict['charts']:
+            if not _import_pil():
+                logerr("charts need the python Pillow (PIL) module, "
+                       "charts disabled")
+                site_dict['charts'] = ''
+            else:
+                site_dict['manager_dict'] = \
+                    weewx.manager.get_manager_dict_from_config(config_dict,
+                                                               data_binding)
 
         site_dict.setdefault('dev_mode', False)
         site_dict['dev_mode'] = to_bool(site_dict.get('dev_mode'))
-        self.dev_mode = site_dict['dev_mode']
 
         # The site_dict values are obfuscated when using wee_debug
         # This is only for posting log extracts - better safe than sorry!
@@ -325,7 +1321,7 @@ class Toot(weewx.restx.StdRESTbase):
         dict_copy['server_url_mastodon'] = "also removed for privacy"
 
         # visibility : options are ... public, unlisted, private, direct
-        if self.dev_mode:
+        if site_dict['dev_mode']:
             # very chatty... for development only
             site_dict.setdefault('visibility', 'direct')
             site_dict.setdefault('post_interval', '60')
@@ -334,63 +1330,40 @@ class Toot(weewx.restx.StdRESTbase):
             site_dict.setdefault('visibility', 'unlisted')
             site_dict.setdefault('post_interval', '3600')
 
-        logdbg("site_dict is : %s" % site_dict)
-
-        loginf("toot visibility is %s " % site_dict['visibility'])
-
-        # we can bind to archive or loop events, default to archive
-        binding = site_dict.pop('binding', 'archive')
-        if isinstance(binding, list):
-            binding = ','.join(binding)
-        loginf('binding is %s' % binding)
-
-        # run some prechecks
-        # FIXME - probably too early, but they will be generated if allowed to
-        # continue - unless user intervention is truly required
-        """
-        self.template_file = site_dict.get('template_file')
-        if self.template_file:
-            if self.dev_mode:
-                loginf("template_file is %s" % self.template_file)
-            if not os.path.isfile(self.template_file):
-                logerr("Missing file? %s" % self.template_file)
-        self.templatesum_file = site_dict.get('template_last_file')
-        if self.templatesum_file:
-            if self.dev_mode:
-                loginf("templatesum_file is %s" % self.templatesum_file)
-            if not os.path.isfile(self.templatesum_file):
-                logerr("Missing summary file? %s" % self.templatesum_file)
-        """
-        self.image_directory = site_dict.get('image_directory')
-        if self.image_directory:
-            if os.path.isdir(self.image_directory):
-                pass
-            else:
-                logerr("Error accessing directory: %s" % self.image_directory)
-                return
-
-        self.data_queue = queue.Queue()
-        data_thread = TootThread(self.data_queue, **site_dict)
-        data_thread.start()
-
-        if 'loop' in binding.lower():
-            self.bind(weewx.NEW_LOOP_PACKET, self.handle_new_loop)
-        if 'archive' in binding.lower():
-            self.bind(weewx.NEW_ARCHIVE_RECORD, self.handle_new_archive)
-
-        loginf("Data will be tooted for %s" % site_dict['station'])
+        return site_dict
 
     def handle_new_loop(self, event):
-        # Make a copy... we will modify it
-        packet = dict(event.packet)
-        packet['binding'] = 'loop'
-        self.data_queue.put(packet)
+        if self.post_loop:
+            # Make a copy... we will modify it
+            packet = dict(event.packet)
+            packet['binding'] = 'loop'
+            self.data_queue.put(packet)
+        for name in self.loop_feeds:
+            self.data_queue.put(dict(event.packet, binding='loop', feed=name))
 
     def handle_new_archive(self, event):
-        # Make a copy... we will modify it
-        record = dict(event.record)
-        record['binding'] = 'archive'
-        self.data_queue.put(record)
+        if self.post_archive:
+            # Make a copy... we will modify it
+            record = dict(event.record)
+            record['binding'] = 'archive'
+            self.data_queue.put(record)
+        for name in self.archive_feeds:
+            self.data_queue.put(dict(event.record, binding='archive',
+                                     feed=name))
+
+    def handle_alert_loop(self, event):
+        # This runs for every LOOP packet, on the engine thread. Only copy the
+        # packet once a rule has fired.
+        packet = event.packet
+        for rule in self.alert_rules:
+            value = packet.get(rule.observation)
+            if value is not None and rule.check(value, packet['dateTime']):
+                record = dict(packet)
+                record['binding'] = 'alert'
+                record['alert'] = rule.name
+                record['alert_format'] = rule.format
+                record['alert_ts'] = time.time()
+                self.data_queue.put(record)
 
 
 class TootThread(weewx.restx.RESTThread):
@@ -399,6 +1372,14 @@ class TootThread(weewx.restx.RESTThread):
                  key_access_token, server_url_mastodon, visibility,
                  cardinal, format_choice, station, format, format_None,
                  ordinals, post_interval,
+                 charts='', chart_hours=24, chart_width=400, chart_height=150,
+                 manager_dict=None,
+                 metrics_file='', metrics_port=None,
+                 metrics_address='127.0.0.1',
+                 trace_sample=0, trace_file='', trace_profile_dir='',
+                 gateway_socket='', gateway_timeout=300,
+                 limits_ttl=86400, max_thread=4,
+                 feeds=None, parent=None, data_binding=None,
                  format_utc=True, format_ordinal=True,
                  unit_system=None, skip_upload=False,
                  log_success=True, log_failure=True,
@@ -406,7 +1387,7 @@ class TootThread(weewx.restx.RESTThread):
                  timeout=60, max_tries=3, retry_wait=5):
         super(TootThread, self).__init__(queue,
                                          protocol_name='Mastodon',
-                                         manager_dict=None,
+                                         manager_dict=manager_dict,
                                          post_interval=post_interval,
                                          max_backlog=max_backlog,
                                          stale=stale,
@@ -416,8 +1397,20 @@ class TootThread(weewx.restx.RESTThread):
                                          timeout=timeout,
                                          retry_wait=retry_wait)
 
-        self.mstdn = Mastodon(access_token=key_access_token,
-                              api_base_url=server_url_mastodon)
+        self.key_access_token = key_access_token
+        self.server_url_mastodon = server_url_mastodon
+        # with a gateway, it does the posting and holds the client
+        self.gateway_socket = gateway_socket
+        self.gateway_timeout = float(gateway_timeout)
+        # the client is made on first use, see the mstdn property
+        self._mstdn = None
+        self._mstdn_lock = threading.Lock()
+        # the instance limits, see get_limits
+        self.limits = None
+        self.limits_ts = 0
+        self.limits_ttl = float(limits_ttl)
+        # the most posts a long toot may be split into
+        self.max_thread = int(max_thread)
 
         self.image_server = server_url_image
         self.image_directory = image_directory
@@ -457,6 +1450,30 @@ class TootThread(weewx.restx.RESTThread):
         # since.py rain offset.
         self.summary_time = int(9)
 
+        if isinstance(charts, str):
+            charts = [charts] if charts else []
+        self.charts = charts
+        self.chart_hours = float(chart_hours)
+        self.chart_width = int(chart_width)
+        self.chart_height = int(chart_height)
+        self.chart_cache = collections.OrderedDict()
+
+        if parent is not None:
+            # a feed shares the client, metrics and images of its parent
+            self.metrics = parent.metrics
+        elif metrics_file or metrics_port:
+            self.metrics = TootMetrics(station, metrics_file, metrics_port,
+                                       metrics_address)
+        else:
+            self.metrics = NullMetrics()
+
+        # trace 1 in trace_sample records
+        self.trace_sample = int(trace_sample)
+        self.trace_file = trace_file
+        self.trace_profile_dir = trace_profile_dir
+        self.trace_count = 0
+        self.trace = None
+
         if self.format_ordinal:
             # backwards compatability with twitter method
             self.cardinal = 'ord'
@@ -464,36 +1481,96 @@ class TootThread(weewx.restx.RESTThread):
             # text for degrees direction
             self.cardinal = 'deg'
 
-    def format_toot(self, record):
-        # from mqtt.py
-        UNIT_REDUCTIONS = {
-            'degree_F': 'F',
-            'degree_C': 'C',
-            'inch': 'in',
-            'mile_per_hour': 'mph',
-            'mile_per_hour2': 'mph',
-            'km_per_hour': 'kph',
-            'km_per_hour2': 'kph',
-            'meter_per_second': 'mps',
-            'meter_per_second2': 'mps',
-            'degree_compass': None,
-            'watt_per_meter_squared': 'Wpm2',
-            'uv_index': None,
-            'percent': '%',
-            'unix_epoch': None,
-        }
-        msg = self.format
+        self.parent = parent
+        self.data_binding = data_binding
+        self.image_cache = parent.image_cache if parent else ImageCache()
+        # the database managers of the feeds, opened on first use
+        self.managers = {}
+        # the feeds are rendered and posted by this thread, see process_feed
+        self.feeds = {}
+        for name, feed_dict in (feeds or {}).items():
+            self.feeds[name] = TootThread(None, parent=self, **feed_dict)
+
+    @property
+    def mstdn(self):
+        """The Mastodon client, made on first use. None with a gateway."""
+        if self.parent is not None:
+            return self.parent.mstdn
+        if self.gateway_socket:
+            return None
+        with self._mstdn_lock:
+            if self._mstdn is None:
+                client = _import_client()
+                t0 = time.time()
+                # Mastodon.py 1.x asks the server for its version here
+                self._mstdn = client(access_token=self.key_access_token,
+                                     api_base_url=self.server_url_mastodon,
+                                     request_timeout=self.timeout)
+                loginf("Mastodon client for %s made in %.3f seconds" % (
+                       self.server_url_mastodon, time.time() - t0))
+        return self._mstdn
+
+    @mstdn.setter
+    def mstdn(self, client):
+        self._mstdn = client
+
+    def run(self):
+        if not self.gateway_socket:
+            self.warm_up()
+        else:
+            self.get_limits()
+        try:
+            super(TootThread, self).run()
+        finally:
+            for manager in self.managers.values():
+                manager.close()
+
+    def warm_up(self):
+        """Make the client, check the access token, open the connection that
+        the posts will reuse and cache the instance limits, before the first
+        record arrives. A failure is logged, not fatal, the posts will retry.
+        """
+        t0 = time.time()
+        try:
+            mstdn = self.mstdn
+            with self.stage('verify_credentials'):
+                account = mstdn.account_verify_credentials()
+            with self.stage('instance'):
+                self.limits = instance_limits(mstdn.instance())
+            self.limits_ts = time.time()
+        except Exception as e:
+            logerr("unable to log in to %s, check key_access_token and "
+                   "server_url_mastodon: %s" % (self.server_url_mastodon, e))
+            return
+        loginf("logged in to %s as %s in %.3f seconds, limits %s" % (
+               self.server_url_mastodon, account.get('acct'),
+               time.time() - t0, self.limits))
+
+    def skip_this_post(self, time_ts):
+        # alerts are not held back by the post_interval, nor do they count
+        # towards it
+        current = getattr(self.queue, 'current', None)
+        if current is not None and current.get('binding') == 'alert':
+            return False
+        if current is not None and current.get('feed') in self.feeds:
+            # each feed keeps its own post_interval
+            return self.feeds[current['feed']].skip_this_post(time_ts)
+        if super(TootThread, self).skip_this_post(time_ts):
+            self.metrics.inc('records_dropped_interval')
+            return True
+        return False
+
+    def format_toot(self, record, fmt_string=None):
+        msg = fmt_string or self.format
+        # what was replaced, for a traced post
+        replaced = [] if self.trace is not None else None
         for obs in record:
             oldstr = None
             fmt = '%s'
             pattern = "{%s}" % obs
             m = re.search(pattern, msg)
             if m:
-                if self.dev_mode:
-                    loginf("START pattern = %s in %s" % (pattern, msg))
                 oldstr = m.group(0)
-                if self.dev_mode:
-                    loginf("  oldstr = %s" % oldstr)
             else:
                 pattern = "{%s:([^}]+)}" % obs
                 m = re.search(pattern, msg)
@@ -502,7 +1579,8 @@ class TootThread(weewx.restx.RESTThread):
                     fmt = m.group(1)
             if oldstr is not None:
                 abv_unit = ' '
-                if obs == 'dateTime':
+                if obs == 'dateTime' or (obs.endswith(TIME_SUFFIXES) and
+                                         record[obs] is not None):
                     if self.format_utc:
                         ts = time.gmtime(record[obs])
                     else:
@@ -514,13 +1592,14 @@ class TootThread(weewx.restx.RESTThread):
                     if self.cardinal == 'ord':
                         newstr = (_dir_to_ord(record[obs], self.ordinals))
                     else:  # label in degrees
+                        newstr = fmt % record[obs]
                         abv_unit = 'deg'
-                elif obs == 'station':
+                elif obs in ('station', 'alert'):
                     newstr = fmt % record[obs]
                 else:
                     (unit_type, _) = weewx.units.getStandardUnitType(
-                                                 self.unit_system, obs)
-                    abv_unit = UNIT_REDUCTIONS.get(unit_type, unit_type)
+                                         self.unit_system, _obs_type(obs))
+                    abv_unit = UNIT_REDUCTIONS.get(unit_type, unit_type) or ' '
                     # manual overide for unconventional unit mix !
                     # FIXME
                     # if abv_unit == 'mps':
@@ -528,28 +1607,183 @@ class TootThread(weewx.restx.RESTThread):
                     # elif abv_unit == 'mbar':
                     #     abv_unit = 'hPa'
                     newstr = fmt % record[obs]
-                    if self.dev_mode:
-                        loginf("Replace with oldstr %s : newstr  %s : abv_unit = %s " %
-                               (oldstr, newstr, abv_unit))
-                if self.dev_mode:
-                    loginf("obs %s : record %s and unit %s" % (record[obs],
-                                                               obs,
-                                                               abv_unit))
+                if replaced is not None:
+                    replaced.append([oldstr, newstr, abv_unit])
                 msg = msg.replace(oldstr, (newstr + ' ' + abv_unit))
 
+        if replaced is not None:
+            self.trace.annotate('replaced', replaced)
         logdbg('format msg: %s' % msg)
         return msg
 
-    def process_record(self, record, dummy_manager):
+    def format_batch(self, columns, fmt_string=None):
+        """Render a block of records, given as columns of equal length, eg
+        {'dateTime': [...], 'usUnits': [...], 'outTemp': [...]}.
+
+        Returns a toot for each record, the same string _process_record
+        would render from it with to_std_system and format_toot. The
+        placeholders are found once for the block, each observation the
+        format uses is converted for every record at once and wind
+        directions are looked up in ordinals as one index. Without numpy,
+        or with a format whose result could depend on the text put into
+        it, the block is rendered record by record.
+        """
+        msg = fmt_string or self.format
+        keys = list(columns)
+        nrecs = len(columns[keys[0]]) if keys else 0
+
+        def one(i):
+            record = dict((k, columns[k][i]) for k in keys)
+            if self.unit_system is not None:
+                record = weewx.units.to_std_system(record, self.unit_system)
+            record['station'] = self.station
+            return self.format_toot(record, msg)
+
+        plan = None
+        if _import_numpy() is not None and (self.unit_system is None or
+                               'usUnits' in columns):
+            plan = _plan_format(msg, keys if 'station' in columns
+                                else keys + ['station'])
+        if plan is None:
+            return [one(i) for i in range(nrecs)]
+        placeholders, template, slots = plan
+
+        values = dict(columns)
+        values['station'] = [self.station] * nrecs
+        if self.unit_system is not None:
+            groups = {}
+            for i, system in enumerate(columns['usUnits']):
+                groups.setdefault(system, []).append(i)
+            # every key, as to_std_system would fail on any of them
+            funcs = dict((k, dict((system, None if system == self.unit_system
+                                   else _conversion(k, system,
+                                                    self.unit_system))
+                                  for system in groups))
+                         for k in keys if k != 'usUnits')
+            for obs, _ in placeholders:
+                if obs in funcs:
+                    values[obs] = _convert_column(columns[obs], groups,
+                                                  funcs[obs])
+            values['usUnits'] = [self.unit_system] * nrecs
+
+        to_tm = time.gmtime if self.format_utc else time.localtime
+        texts = []
+        for obs, fmt in placeholders:
+            column = values[obs]
+            if obs == 'dateTime' or obs.endswith(TIME_SUFFIXES):
+                text = [self.format_None + '  '
+                        if v is None and obs != 'dateTime'
+                        else time.strftime(fmt, to_tm(v)) + '  '
+                        for v in column]
+            elif obs == 'windDir' and self.cardinal == 'ord':
+                text = [self.format_None + '  ' if v is None else v + '  '
+                        for v in _dir_to_ords(column, self.ordinals)]
+            else:
+                if obs == 'windDir':
+                    label = ' deg'
+                elif obs in ('station', 'alert'):
+                    label = '  '
+                elif all(v is None for v in column):
+                    label = None
+                else:
+                    (unit_type, _) = weewx.units.getStandardUnitType(
+                                         self.unit_system, _obs_type(obs))
+                    label = ' ' + (UNIT_REDUCTIONS.get(unit_type, unit_type)
+                                   or ' ')
+                text = [self.format_None + '  ' if v is None
+                        else fmt % v + label for v in column]
+            texts.append(text)
+
+        toots = []
+        for i in range(nrecs):
+            row = tuple(texts[n][i] for n in slots)
+            if any('{' in t or '}' in t for t in row):
+                # it could make a placeholder, format_toot knows what then
+                toots.append(one(i))
+            else:
+                toots.append(template % row)
+        logdbg('format_batch rendered %d toots' % nrecs)
+        return toots
+
+    def stage(self, name, **attrs):
+        """Time a 'with' block, into the metrics and any trace."""
+        if self.trace is None:
+            return self.metrics.stage(name)
+        return _Span(self.trace, self.metrics, name, attrs)
+
+    def annotate(self, key, value):
+        if self.trace is not None:
+            self.trace.annotate(key, value)
+
+    def process_record(self, record, dbmanager):
+        self.metrics.set('queue_depth', self.queue.qsize())
+        self.metrics.inc('records_processed')
+        profiler = None
+        self.trace_count += 1
+        if self.trace_sample and self.trace_count % self.trace_sample == 0:
+            self.trace = TootTrace(self.station, record)
+            if self.trace_profile_dir:
+                profiler = cProfile.Profile()
+                profiler.enable()
+        outcome = 'done'
+        try:
+            self._process_record(record, dbmanager)
+        except weewx.restx.FailedPost as e:
+            self.metrics.inc('post_failures')
+            outcome = 'failed: %s' % e
+            raise
+        except Exception as e:
+            outcome = 'error: %s' % e
+            raise
+        finally:
+            self.metrics.export()
+            if self.trace is not None:
+                self.end_trace(outcome, profiler)
+
+    def end_trace(self, outcome, profiler):
+        """Save the profile, and write out the trace, of a sampled post."""
+        trace = self.trace
+        self.trace = None
+        if profiler is not None:
+            profiler.disable()
+            path = os.path.join(self.trace_profile_dir,
+                                'wxtoot-%d-%d.pstats' % (int(trace.start),
+                                                         self.trace_count))
+            try:
+                profiler.dump_stats(path)
+                trace.attrs['profile'] = path
+            except (IOError, OSError) as e:
+                logerr("unable to save profile %s: %s" % (path, e))
+        line = json.dumps(trace.as_dict(outcome), default=str)
+        if not self.trace_file:
+            loginf("trace %s" % line)
+            return
+        try:
+            with open(self.trace_file, 'a') as f:
+                f.write(line + '\n')
+        except (IOError, OSError) as e:
+            logerr("unable to write trace file %s: %s" % (self.trace_file, e))
+
+    def _process_record(self, record, dbmanager):
+        feed = self.feeds.get(record.pop('feed', None))
+        if feed is not None:
+            self.process_feed(feed, record, dbmanager)
+            return
+
         if self.unit_system is not None:
             record = weewx.units.to_std_system(record, self.unit_system)
         record['station'] = self.station
 
+        if record.get('binding') == 'alert':
+            self.process_alert(record)
+            return
+
         if self.format_choice == 'template' and self.template_file:
             ts = time.localtime()
             if ts.tm_hour == self.summary_time and self.templatesum_file:
                 try:
-                    with open(self.templatesum_file, 'r') as f:
+                    with self.stage('template_read'), \
+                         open(self.templatesum_file, 'r') as f:
                         msg = f.read()
                         msg = msg.replace("\\n", "\n")
                 except Exception as e:
@@ -559,7 +1793,8 @@ class TootThread(weewx.restx.RESTThread):
                     msg = "Missing summary template file"
             else:
                 try:
-                    with open(self.template_file, 'r') as f:
+                    with self.stage('template_read'), \
+                         open(self.template_file, 'r') as f:
                         msg = f.read()
                         msg = msg.replace("\\n", "\n")
                 except Exception as e:
@@ -567,128 +1802,418 @@ class TootThread(weewx.restx.RESTThread):
                             self.template_file, e))
                     msg = "Missing template file"
         else:
-            msg = self.format_toot(record)
+            with self.stage('render'):
+                msg = self.format_toot(record)
 
         if self.skip_upload:
             loginf('skipping upload')
+            self.annotate('skip_upload', True)
             return
 
-        # now do the posting
-        self.post_with_retries(msg)
+        charts = None
+        if self.charts and dbmanager is not None:
+            try:
+                with self.stage('chart'):
+                    charts = self.make_charts(record, dbmanager)
+            except Exception as e:
+                # a missing chart is no reason to miss the toot
+                logerr("chart generation failed with %s" % e)
 
-    def post_with_retries(self, msg):
-        ntries = 0
-        while ntries < self.max_tries:
-            ntries += 1
-            imgs = ''
+        # now do the posting
+        self.post_with_retries(msg, charts=charts)
+
+    def process_feed(self, feed, record, dbmanager):
+        """Render and post a record for one of the feeds. A feed with a
+        data_binding of its own posts the latest record from it."""
+        if feed.data_binding:
+            # a bad database fails this post, not the thread every other
+            # feed, and the station itself, posts from
             try:
-                # fetch an image from a web server
-                our_images = []
-                img_0 = ''
-                dev_msg = 'DEV_MODE : '
-                if self.image_server:
-                    # Only the web server? Then put the img files in /tmp
-                    if not self.image_directory:
-                        self.serv_image_directory = '/tmp/'
-                    else:
-                        self.serv_image_directory = self.image_directory
-                    image = requests.get(self.image_server, stream=True)
-                    if image.status_code == 200:
-                        # Set decode_content value to True, otherwise the
-                        # downloaded image file's size will be zero.
-                        image.raw.decode_content = True
-                    img_0 = (self.serv_image_directory+'wxgraphic.png')
-
-                    with open(img_0, 'wb') as f:
-                        shutil.copyfileobj(image.raw, f)
-                    our_images.append(img_0)
-                    logdbg("Image server fetched %s (%s)" % (img_0, image))
-                    if self.dev_mode:
-                        loginf("Image server fetched %s (%s)" % (img_0, image))
-                        dev_msg += ": With server image : "
-
-                # fetch images from the local file system as named files
-                if self.images and self.image_directory:
-                    if self.dev_mode:
-                        loginf("len of named images ... %s" % len(self.images))
-                    for imgs in self.images:
-                        our_images.append(self.image_directory+imgs)
-                    our_images = our_images[:4]
-                    if self.dev_mode:
-                        loginf("our local image list is %s" % our_images)
-                        dev_msg += " : With named images : "
-                # or via a directory search (allows changing image names)
-                elif self.image_directory:
-                    if self.dev_mode:
-                        loginf("image directory only")
-                    self.allow_ext = '.png'
-                    for imgs in glob.iglob(f'{self.image_directory}/*'):
-                        if (imgs == img_0):
-                            continue
-                        if (imgs.endswith(".png")) or \
-                           (imgs.endswith(".jpg")):
-                            our_images.append(imgs)
-                        elif (imgs.endswith(".gif")) or \
-                             (imgs.endswith(".webp")):
-                            our_images.append(imgs)
-                    if self.dev_mode:
-                        dev_msg += " : With unnamed images : "
-                # but there can be only 1^H 4
-                our_images = our_images[:4]
+                dbmanager = self.open_manager(feed.data_binding,
+                                              feed.manager_dict)
+                with self.stage('feed_read', feed=feed.station):
+                    latest = dbmanager.getRecord(dbmanager.lastGoodStamp())
+            except (weedb.DatabaseError, IOError, OSError) as e:
+                self.close_manager(feed.data_binding)
+                raise weewx.restx.FailedPost("feed %s, %s: %s" % (
+                    feed.station, feed.data_binding, e))
+            if latest is None:
+                raise weewx.restx.AbortedPost("no records in %s" %
+                                              feed.data_binding)
+            latest['binding'] = record['binding']
+            record = latest
+        self.annotate('feed', feed.station)
+        feed.trace = self.trace
+        try:
+            feed._process_record(record, dbmanager)
+        finally:
+            feed.trace = None
+
+    def open_manager(self, data_binding, manager_dict):
+        """The manager for data_binding, opened by this thread on first use
+        and kept until it ends, or fails."""
+        if data_binding not in self.managers:
+            self.managers[data_binding] = \
+                weewx.manager.open_manager(manager_dict)
+        return self.managers[data_binding]
+
+    def close_manager(self, data_binding):
+        """Forget a failed manager, the next record opens it again."""
+        manager = self.managers.pop(data_binding, None)
+        if manager is not None:
+            try:
+                manager.close()
+            except Exception as e:
+                logdbg("closing %s: %s" % (data_binding, e))
 
-                if self.dev_mode:
-                    loginf("%s : number of images %s " % (our_images,
-                                                          len(our_images)))
+    def process_alert(self, record):
+        """Toot an alert straight away, without images."""
+        fmt_string = record.pop('alert_format')
+        alert_ts = record.pop('alert_ts')
+        with self.stage('render'):
+            msg = self.format_toot(record, fmt_string)
+
+        if self.skip_upload:
+            loginf('skipping upload of alert %s' % record['alert'])
+            return
+
+        self.post_with_retries(msg, media=False)
+        loginf("alert %s posted %.3f seconds after its packet" % (
+               record['alert'], time.time() - alert_ts))
+
+    def make_charts(self, record, dbmanager):
+        """Render the configured charts, from the database, as PNG bytes.
+
+        Returns a list of (file_name, png_bytes). The window moves on with
+        every record, but what is in it only changes when a record is
+        archived, so the charts are cached on the first and last dateTime,
+        and the count, of the archive records in it. Feeds share the cache
+        of their parent. A retry posts the charts it was given, it does not
+        come back here.
+        """
+        stop_ts = record['dateTime']
+        start_ts = stop_ts - self.chart_hours * 3600
+        span = dbmanager.getSql(
+            "SELECT MIN(dateTime), MAX(dateTime), COUNT(*) FROM %s "
+            "WHERE dateTime > ? AND dateTime <= ?" % dbmanager.table_name,
+            (start_ts, stop_ts))
+        key = (dbmanager.database_name, dbmanager.table_name,
+               tuple(self.charts), self.unit_system, self.chart_width,
+               self.chart_height, tuple(span))
+        cache = (self.parent or self).chart_cache
+        if key in cache:
+            cache.move_to_end(key)
+            self.metrics.inc('chart_cache_hits')
+            return cache[key]
+
+        sql = "SELECT dateTime, usUnits, %s FROM %s " \
+              "WHERE dateTime > ? AND dateTime <= ? ORDER BY dateTime" % (
+                  ', '.join(self.charts), dbmanager.table_name)
+        rows = list(dbmanager.genSql(sql, (start_ts, stop_ts)))
+        charts = []
+        if rows:
+            times = [row[0] for row in rows]
+            us_units = rows[-1][1]
+            for i, obs in enumerate(self.charts):
+                (unit, group) = weewx.units.getStandardUnitType(us_units, obs)
+                vt = weewx.units.ValueTuple([row[i + 2] for row in rows],
+                                            unit, group)
+                if self.unit_system is not None:
+                    vt = weewx.units.convertStd(vt, self.unit_system)
+                png = _render_chart(obs, times, vt[0],
+                                    UNIT_REDUCTIONS.get(vt[1], vt[1]),
+                                    self.chart_width, self.chart_height)
+                charts.append(('%s.png' % obs, png))
+        # the latest window for each feed is all that is worth keeping
+        cache[key] = charts
+        while len(cache) > CHART_CACHE_SIZE:
+            cache.popitem(last=False)
+        return charts
+
+    def select_images(self, dev_msg):
+        """Return the image files to upload, and the updated dev_msg."""
+        our_images = []
+        img_0 = ''
+        # fetch an image from a web server
+        if self.image_server:
+            # Only the web server? Then put the img files in /tmp
+            if not self.image_directory:
+                self.serv_image_directory = '/tmp/'
+            else:
+                self.serv_image_directory = self.image_directory
+            # a file for each url, so feeds sharing the directory (and the
+            # fetch cache) do not upload one another's image
+            img_0 = (self.serv_image_directory + 'wxgraphic-%s.png' %
+                     hashlib.sha1(self.image_server.encode('utf-8'))
+                     .hexdigest()[:12])
+            with self.stage('image_fetch'):
+                status = self.image_cache.fetch(self.image_server, img_0)
+                self.annotate('status', status)
+            our_images.append(img_0)
+            logdbg("Image server fetched %s (%s)" % (img_0, status))
+            if self.dev_mode:
+                dev_msg += ": With server image : "
 
+        # fetch images from the local file system as named files
+        if self.images and self.image_directory:
+            for imgs in self.images:
+                our_images.append(self.image_directory+imgs)
+            if self.dev_mode:
+                dev_msg += " : With named images : "
+        # or via a directory search (allows changing image names)
+        elif self.image_directory:
+            with self.stage('image_scan', directory=self.image_directory):
+                for imgs in self.image_cache.scan(self.image_directory):
+                    # fetched from an image server, by this or another feed,
+                    # or left by 0.04 which named every fetch wxgraphic.png
+                    name = os.path.basename(imgs)
+                    if name.startswith('wxgraphic-') or \
+                       name == 'wxgraphic.png':
+                        continue
+                    our_images.append(imgs)
+                self.annotate('found', len(our_images))
+            if self.dev_mode:
+                dev_msg += " : With unnamed images : "
+        return our_images, dev_msg
+
+    def post_with_retries(self, msg, media=True, charts=None):
+        """Check msg and its media against the instance limits, then post
+        it, as a reply thread if it is too long for one status. Each post
+        is retried up to max_tries. Nothing goes out for a post that can
+        not be sent, that is an AbortedPost."""
+        limits = self.get_limits()
+        # a toot too long to send is dropped before any image is fetched
+        parts = self.split_parts(msg, limits)
+        dev_msg = 'DEV_MODE : '
+        our_images = []
+        if media:
+            try:
+                our_images, dev_msg = self.select_images(dev_msg)
             except Exception as e:
                 logerr("image selection failed with %s" % e)
                 raise
-
-            # Mastodon posting- Mastodon.media_post
-            logdbg("number of images for upload %s" % len(our_images))
-            if len(our_images) != 0:
-                media_list = []
-                for media in range(len(our_images)):
-                    if self.dev_mode:
-                        loginf("media is %s" % our_images[media])
-                    if os.path.isfile(our_images[media]):
-                        try:
-                            media_id = self.mstdn.media_post(our_images[media])
-                            media_list.append(media_id)
-                        except Exception as e:
-                            raise weewx.restx.FailedPost("mastodon failed: %s" % e)
-                    else:
-                        pass
-                        if self.dev_mode:
-                            loginf("media is not a file %s and of type %s" % (
-                                   our_images[media], type(our_images[media])))
+            # the charts are in memory and go ahead of the files
+            if charts:
+                our_images = list(charts) + our_images
                 if self.dev_mode:
-                    loginf("our media_list images are %s : %s" % (media,
-                                                                  media_list))
+                    dev_msg += " : With charts : "
+        if self.dev_mode:
+            dev_msg += ' : '+self.format_choice+'\n'
+            msg += '\n'+dev_msg
+            parts = self.split_parts(msg, limits)
+        # spread the media over the posts, max_media to each
+        per_post = limits['max_media']
+        our_images = self.check_media(our_images, limits,
+                                      per_post * len(parts))
+
+        if not msg.strip() and not our_images:
+            raise weewx.restx.AbortedPost("nothing to post")
+        self.annotate('images', [u[0] if isinstance(u, tuple) else u
+                                 for u in our_images])
+        if len(parts) > 1:
+            self.annotate('thread', len(parts))
+        reply_to = None
+        for n, text in enumerate(parts):
+            batch = our_images[n * per_post:(n + 1) * per_post]
+            reply_to = self.post_part(text, batch, reply_to)
+
+    def split_parts(self, msg, limits):
+        """Split msg into the posts of a thread, AbortedPost if it needs
+        more than max_thread."""
+        parts = split_toot(msg, limits['max_characters'],
+                           limits['characters_reserved_per_url'])
+        if len(parts) > self.max_thread:
+            raise weewx.restx.AbortedPost(
+                "%d characters needs %d posts, more than max_thread (%d)" % (
+                    len(msg), len(parts), self.max_thread))
+        return parts
+
+    def post_part(self, msg, our_images, reply_to=None):
+        """Post one status, retrying up to max_tries. Return its id.
+
+        A retry only repeats what failed: the media already uploaded is
+        kept, and every try sends the same idempotency key, so a status the
+        server took, but did not answer for, is not posted twice.
+        """
+        uploaded = {}
+        idempotency_key = uuid.uuid4().hex
+        ntries = 0
+        while ntries < self.max_tries:
+            ntries += 1
+            try:
+                return self.post_toot(msg, our_images, reply_to, uploaded,
+                                      idempotency_key)
+            except weewx.restx.FailedPost as e:
+                if ntries >= self.max_tries:
+                    raise
+                logerr("%s, try %d of %d, retrying in %s seconds" % (
+                       e, ntries, self.max_tries, self.retry_wait))
+                self.annotate('retries', ntries)
+                self.metrics.inc('retries')
+                time.sleep(self.retry_wait)
+        else:
+            raise weewx.restx.FailedPost("Max retries (%d) exceeded" %
+                                         self.max_tries)
+
+    def get_limits(self):
+        """The instance limits, fetched again once they are limits_ttl
+        seconds old, through the gateway if there is one. The Mastodon
+        defaults if the server can not be asked."""
+        if self.parent is not None:
+            return self.parent.get_limits()
+        if self.limits is None or \
+           time.time() - self.limits_ts > self.limits_ttl:
+            try:
+                with self.stage('instance'):
+                    self.limits = instance_limits(self.get_instance())
+                self.limits_ts = time.time()
+            except Exception as e:
+                logerr("unable to fetch the instance limits: %s" % e)
+                if self.limits is None:
+                    self.limits = instance_limits({})
+                # ask again in 5 minutes, not on every post
+                self.limits_ts = time.time() - self.limits_ttl + 300
+        return self.limits
+
+    def get_instance(self):
+        """The instance() response, or the part of it with the limits that
+        the gateway passes on."""
+        if not self.gateway_socket:
+            return self.mstdn.instance()
+        request = {'limits': True,
+                   'server': self.server_url_mastodon,
+                   'token': self.key_access_token}
+        try:
+            reply = gateway_request(self.gateway_socket, request,
+                                    self.gateway_timeout)
+        except (IOError, OSError, ValueError) as e:
+            raise IOError("gateway %s failed: %s" % (self.gateway_socket, e))
+        if not reply.get('ok'):
+            raise IOError("gateway: %s" % reply.get('error'))
+        return reply['instance']
+
+    def check_media(self, our_images, limits, wanted):
+        """Drop the media that is missing, or too big to upload.
+
+        Stops once wanted uploads have been found, so a large
+        image_directory is not stat'ed past what the posts can carry."""
+        checked = []
+        size_limit = limits['image_size_limit']
+        for n, upload in enumerate(our_images):
+            if len(checked) >= wanted:
+                logdbg("dropping %d images, over %d for this toot" % (
+                       len(our_images) - n, wanted))
+                break
+            if isinstance(upload, tuple):
+                # a chart, (file_name, png_bytes)
+                name, size = upload[0], len(upload[1])
+            elif os.path.isfile(upload):
+                name, size = upload, os.path.getsize(upload)
+            else:
+                logdbg("media is not a file %s" % upload)
+                self.annotate('not_a_file', upload)
+                continue
+            if size_limit and size > size_limit:
+                logerr("%s is %d bytes, over the %d byte limit, skipping" % (
+                       name, size, size_limit))
+                self.annotate('too_big', name)
+                continue
+            checked.append(upload)
+        return checked
+
+    def post_toot(self, msg, our_images, reply_to=None, uploaded=None,
+                  idempotency_key=None):
+        """Upload our_images, then post msg with them attached, as a reply
+        to the status reply_to if that is given. Return the status id.
+
+        uploaded maps the index of each image already uploaded, by an
+        earlier try, to its media id, and gains the ones uploaded now.
+        """
+        if self.gateway_socket:
+            return self.gateway_post(msg, our_images, reply_to,
+                                     idempotency_key)
+        if uploaded is None:
+            uploaded = {}
+        # Mastodon posting- Mastodon.media_post
+        logdbg("number of images for upload %s" % len(our_images))
+        for n, upload in enumerate(our_images):
+            if n in uploaded:
+                continue
+            if isinstance(upload, tuple):
+                # a chart, (file_name, png_bytes)
                 try:
-                    if self.dev_mode:
-                        dev_msg += ' : '+self.format_choice+'\n'
-                        msg += '\n'+dev_msg
-                    self.mstdn.status_post(msg,
-                                           media_ids=media_list,
-                                           sensitive=False,
-                                           visibility=self.visibility
-                                           )
-                    # ,spoiler_text=msg)
+                    with self.stage('media_post', media=upload[0],
+                                    size=len(upload[1])):
+                        uploaded[n] = self.mstdn.media_post(
+                            io.BytesIO(upload[1]), mime_type='image/png',
+                            file_name=upload[0])
+                    self.metrics.inc('media_uploaded')
+                    self.metrics.inc('upload_bytes', len(upload[1]))
                 except Exception as e:
-                    raise weewx.restx.FailedPost("media_post failed: %s" % e)
+                    raise weewx.restx.FailedPost("mastodon failed: %s" % e)
             else:
                 try:
-                    if self.dev_mode:
-                        dev_msg += ' : '+self.format_choice+'\n'
-                        msg += '\n'+dev_msg
-                    self.mstdn.status_post(msg,
-                                           visibility=self.visibility
-                                           )
-                    return
+                    with self.stage('media_post', media=upload):
+                        uploaded[n] = self.mstdn.media_post(upload)
+                    self.metrics.inc('media_uploaded')
+                    self.metrics.inc('upload_bytes', os.path.getsize(upload))
                 except Exception as e:
-                    raise weewx.restx.FailedPost("status_post failed: %s" % e)
-            return
-        else:
-            raise weewx.restx.FailedPost("Max retries (%d) exceeded" %
-                                         self.max_tries)
+                    raise weewx.restx.FailedPost("mastodon failed: %s" % e)
+        media_list = [uploaded[n] for n in range(len(our_images))]
+        try:
+            with self.stage('status_post', length=len(msg),
+                            media=len(media_list)):
+                if media_list:
+                    status = self.mstdn.status_post(
+                        msg, media_ids=media_list, sensitive=False,
+                        visibility=self.visibility, in_reply_to_id=reply_to,
+                        idempotency_key=idempotency_key)
+                    # ,spoiler_text=msg)
+                else:
+                    status = self.mstdn.status_post(
+                        msg, visibility=self.visibility,
+                        in_reply_to_id=reply_to,
+                        idempotency_key=idempotency_key)
+        except Exception as e:
+            raise weewx.restx.FailedPost("status_post failed: %s" % e)
+        self.metrics.inc('posts')
+        self.metrics.set('last_success_timestamp_seconds', int(time.time()))
+        return status['id']
+
+    def gateway_post(self, msg, our_images, reply_to=None,
+                     idempotency_key=None):
+        """Hand msg, and references to our_images, to the gateway to post.
+        Return the status id. A try the gateway still has, after this end
+        gave up waiting, is not posted again for the same idempotency_key.
+        """
+        media = []
+        for upload in our_images:
+            if isinstance(upload, tuple):
+                # a chart, it only exists here so it goes in the request
+                media.append({'name': upload[0], 'mime': 'image/png',
+                              'data': base64.b64encode(
+                                  upload[1]).decode('ascii')})
+            else:
+                media.append({'path': os.path.abspath(upload)})
+        request = {'station': self.station,
+                   'server': self.server_url_mastodon,
+                   'token': self.key_access_token,
+                   'status': msg,
+                   'visibility': self.visibility,
+                   'in_reply_to_id': reply_to,
+                   'idempotency_key': idempotency_key,
+                   'media': media}
+        try:
+            with self.stage('gateway_post', length=len(msg),
+                            media=len(media)):
+                reply = gateway_request(self.gateway_socket, request,
+                                        self.gateway_timeout)
+        except (IOError, OSError, ValueError) as e:
+            raise weewx.restx.FailedPost("gateway %s failed: %s" % (
+                                         self.gateway_socket, e))
+        if not reply.get('ok'):
+            raise weewx.restx.FailedPost("gateway: %s" % reply.get('error'))
+        self.annotate('gateway', reply)
+        self.metrics.inc('posts')
+        self.metrics.set('last_success_timestamp_seconds', int(time.time()))
+        return reply.get('id')
@@ -36,6 +36,29 @@ wxtoot_config = """
         # example: /var/www/html/weewx/DATA/mastodon.txt
         #template_file = '/var/www/html/weewx/DATA/mastodon.txt'
         #template_last_file = '/var/www/html/weewx/DATA/mastsummary.txt'
+        # charts drawn from the database and uploaded with each toot
+        #charts = outTemp, windSpeed, barometer
+        #chart_hours = 24
+        # stage timings and counters, Prometheus text format
+        #metrics_file = /var/lib/node_exporter/textfile_collector/wxtoot.prom
+        #metrics_port = 9876
+        # trace 1 in N posts, optionally with a cProfile dump of each
+        #trace_sample = 24
+        #trace_file = /var/tmp/wxtoot-trace.jsonl
+        #trace_profile_dir = /var/tmp
+        # a toot over the server's character limit is split into a thread
+        #max_thread = 4
+        # more feeds (other bindings, formats, schedules), see wxtoot.py
+        #[[[Feeds]]]
+        #    [[[[indoor]]]]
+        #        format = {station:%s}: inside {inTemp:%.1f}
+        # post through a shared tootgateway.py, for many stations on one host
+        #gateway_socket = /run/wxtoot/gateway.sock
+        # alert toots from the LOOP packets, see the notes in wxtoot.py
+        #[[[Alerts]]]
+        #    [[[[gust]]]]
+        #        observation = windGust
+        #        above = 20.0
         # post formats - simple, full, template
         format_choice = full
         # must finish with a valid entry as the last entry cannot be a comment
@@ -63,6 +86,8 @@ class MstdnInstaller(ExtensionInstaller):
             files=[
                    ('bin/user',
                     ['bin/user/wxtoot.py',
+                     'bin/user/tootbackfill.py',
+                     'bin/user/tootgateway.py',
                      'bin/user/since.py']),
                    ('skins/Seasons/DATA',
                     ['skins/Seasons/DATA/mastodon.txt.tmpl',